@@ -1,54 +1,33 @@
 import streamlit as st
-import sqlite3
-import fitz  # PyMuPDF
-from PIL import Image, ImageEnhance, ImageFilter
-import io
-import numpy as np
-import cv2
+import time
+import pandas as pd
 from datetime import datetime, timedelta
 from streamlit_drawable_canvas import st_canvas
-import easyocr
-
-# 初始化数据库连接
-conn = sqlite3.connect('users.db')
-c = conn.cursor()
-
-# 检查并创建表
-def create_table_if_not_exists(cursor, table_name):
-    cursor.execute(f"""
-        CREATE TABLE IF NOT EXISTS {table_name} (
-            username TEXT PRIMARY KEY,
-            password TEXT,
-            membership TEXT,
-            role TEXT DEFAULT 'user',
-            credits INTEGER DEFAULT 0,
-            premium_expiry TEXT,
-            free_uses INTEGER DEFAULT 5,
-            last_reset TEXT
-        )
-    """)
-
-create_table_if_not_exists(c, 'users')
-
-# 检查并添加缺失的数据库列
-def add_column_if_not_exists(cursor, table_name, column_name, column_type):
-    cursor.execute(f"PRAGMA table_info({table_name})")
-    columns = [info[1] for info in cursor.fetchall()]
-    if column_name not in columns:
-        cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}")
-
-add_column_if_not_exists(c, 'users', 'membership', 'TEXT')
-add_column_if_not_exists(c, 'users', 'role', 'TEXT DEFAULT "user"')
-add_column_if_not_exists(c, 'users', 'credits', 'INTEGER DEFAULT 0')
-add_column_if_not_exists(c, 'users', 'premium_expiry', 'TEXT')
-add_column_if_not_exists(c, 'users', 'free_uses', 'INTEGER DEFAULT 5')
-add_column_if_not_exists(c, 'users', 'last_reset', 'TEXT')
-
-# 初始化 EasyOCR 读者
-reader = easyocr.Reader(['ch_sim', 'en'])
-
-# 主函数
+from ocr_engine import mark_startup_complete, build_text_boxes
+from ocr_jobs import get_job_manager, JobLimitError
+from pdf_pages import read_pdf, RENDER_DPI, DPI_CHOICES
+from pdf_export import ExportFile, export_pdf
+from page_edits import PageEdits, make_overlay
+from page_store import PageStore
+from db import (init_db, validate_login, validate_signup, create_user, list_users, count_users, delete_users,
+                ADMIN_PAGE_SIZE)
+from quota import (get_user_state, consume_free_use, add_credits, purchase_premium, expire_premium,
+                   reset_all_free_uses, reset_free_uses_for, add_credits_to)
+from metrics import (span, timed, increment, snapshot, reset as reset_metrics, component_stats, render_prometheus,
+                     start_exporter, request_profile, profile_requested, maybe_profile, last_profile)
+
+# 缩略图导航条同时显示的页数
+THUMBNAIL_STRIP_SIZE = 7
+
+# 主函数：统计每次执行（rerun）的次数与耗时；管理员要求分析时以 cProfile 分析这一次执行
 def main():
+    increment('reruns')
+    start_exporter()
+    with span('app.run'), maybe_profile(st.session_state.get('username') or "訪客"):
+        render_app()
+
+# 页面内容
+def render_app():
     st.title("基於Streamlit的PDF圖片提取並進行編輯")
 
     # 初始化session state
@@ -65,7 +44,7 @@ def main():
     # 登录状态判断
     if st.session_state['logged_in']:
         st.sidebar.write(f"歡迎，{st.session_state['username']}！")
-        check_reset_free_uses()
+        sync_user_state()
         user_info()
         if st.session_state['role'] == 'admin':
             admin_page()
@@ -119,60 +98,14 @@ def signup():
         else:
             st.error("名字已存在，請選擇其他名字。")
 
-# 验证登录
-def validate_login(username, password):
-    c.execute("SELECT * FROM users WHERE username = ? AND password = ?", (username, password))
-    return c.fetchone()
-
-# 验证注册
-def validate_signup(username):
-    c.execute("SELECT * FROM users WHERE username = ?", (username,))
-    return c.fetchone()
-
-# 创建用户
-def create_user(username, password, membership, role='user'):
-    c.execute("INSERT INTO users (username, password, membership, role, credits, free_uses, last_reset) VALUES (?, ?, ?, ?, ?, ?, ?)", 
-              (username, password, membership, role, 0, 5, datetime.now().strftime('%Y-%m-%d')))
-    conn.commit()
-
-# 升级会员
-def upgrade_membership(username):
-    expiry_date = (datetime.now() + timedelta(days=30)).strftime('%Y-%m-%d')
-    c.execute("UPDATE users SET membership = 'premium', premium_expiry = ? WHERE username = ?", (expiry_date, username))
-    conn.commit()
-
-# 降级会员
-def downgrade_membership(username):
-    c.execute("UPDATE users SET membership = 'free', premium_expiry = NULL WHERE username = ?", (username,))
-    conn.commit()
-
-# 删除用户
-def delete_user(username):
-    c.execute("DELETE FROM users WHERE username = ?", (username,))
-    conn.commit()
-
-# 更新免费会员的使用次数
-def update_free_uses(username, new_free_uses):
-    c.execute("UPDATE users SET free_uses = ? WHERE username = ?", (new_free_uses, username))
-    conn.commit()
-
-# 检查并重置免费使用次数
-def check_reset_free_uses():
-    last_reset = st.session_state['last_reset']
-    if last_reset:
-        try:
-            last_reset_date = datetime.strptime(str(last_reset), '%Y-%m-%d').date()
-        except ValueError:
-            last_reset_date = datetime.now().date()
-            st.session_state['last_reset'] = last_reset_date.strftime('%Y-%m-%d')
-            c.execute("UPDATE users SET last_reset = ? WHERE username = ?", (st.session_state['last_reset'], st.session_state['username']))
-            conn.commit()
-        current_date = datetime.now().date()
-        if current_date > last_reset_date:
-            st.session_state['free_uses'] = 5
-            st.session_state['last_reset'] = current_date.strftime('%Y-%m-%d')
-            c.execute("UPDATE users SET free_uses = ?, last_reset = ? WHERE username = ?", (5, current_date.strftime('%Y-%m-%d'), st.session_state['username']))
-            conn.commit()
+# 同步用户的会员、点数和免费次数（只读，带短暂缓存）
+# 跨日重置在扣减免费次数时由数据库惰性完成，重新运行页面时不再写数据库
+def sync_user_state():
+    state = get_user_state(st.session_state['username'])
+    if state is None:
+        return
+    for field in ('membership', 'credits', 'premium_expiry', 'free_uses', 'last_reset'):
+        st.session_state[field] = state[field]
 
 # 用户信息显示在侧边栏
 def user_info():
@@ -205,8 +138,7 @@ def user_info():
                 elif not validate_cvv(cvv):
                     st.error('無效的CVV，應為三位數字')
                 else:
-                    update_credits(st.session_state['username'], amount)
-                    st.session_state['credits'] += amount
+                    st.session_state['credits'] = add_credits(st.session_state['username'], amount)
                     st.success(f'成功增加 {amount} 點數！')
                     st.experimental_rerun()
 
@@ -215,11 +147,8 @@ def user_info():
                     st.write(f"您的會員資格將於 {st.session_state['premium_expiry']} 過期，在此之前無法再購買")
                 else:
                     if st.button("使用100點數升級到付費會員", key="upgrade_button"):
-                        if st.session_state['credits'] >= 100:
-                            upgrade_membership(st.session_state['username'])
-                            st.session_state['credits'] -= 100
-                            st.session_state['membership'] = 'premium'
-                            st.session_state['premium_expiry'] = (datetime.now() + timedelta(days=30)).strftime('%Y-%m-%d')
+                        if purchase_premium(st.session_state['username']):
+                            sync_user_state()
                             st.success("升級成功！現在您是付費會員，可以存取更多內容")
                             st.experimental_rerun()
                         else:
@@ -243,9 +172,8 @@ def user_page():
             expiry_date = datetime.strptime(st.session_state['premium_expiry'], '%Y-%m-%d').date()
             remaining_days = (expiry_date - datetime.now().date()).days
             if remaining_days <= 0:
-                downgrade_membership(st.session_state['username'])
-                st.session_state['membership'] = 'free'
-                st.session_state['premium_expiry'] = None
+                expire_premium(st.session_state['username'])
+                sync_user_state()
                 st.warning("您的付費會員已過期。")
                 st.experimental_rerun()
         protected_content()
@@ -260,23 +188,87 @@ def user_page():
 def admin_page():
     st.write("這是管理者介面。您可以管理用戶。")
 
-    users = get_all_users()
-    for user in users:
-        expiry_date_display = user[5] if user[5] else "無"
-        free_uses_display = user[6] if user[6] else "無"
-        credits_display = user[4] if user[4] else 0
-        st.write(f"使用者名稱: {user[0]}, 會員類型: {user[2]}, 角色: {user[3]}, 點數: {credits_display}, 會員到期時間: {expiry_date_display}, 免費使用次數: {free_uses_display}")
-        if user[3] != "admin":  # 管理者不能被删除
-            if st.button(f"刪除 {user[0]}", key=f"delete_button_{user[0]}"):
-                delete_user(user[0])
-                st.success(f"使用者 {user[0]} 已刪除。")
-                st.experimental_rerun()
-    
+    # 统计数字由一次查询得出
+    today = datetime.now().date()
+    counts = count_users(today.strftime('%Y-%m-%d'), (today + timedelta(days=7)).strftime('%Y-%m-%d'))
+    columns = st.columns(5)
+    columns[0].metric("用戶總數", counts['total'])
+    columns[1].metric("付費會員", counts['premium'])
+    columns[2].metric("免費會員", counts['free'])
+    columns[3].metric("管理者", counts['admin'])
+    columns[4].metric("七天內到期", counts['expiring'])
+
+    search_col, membership_col, role_col = st.columns(3)
+    search = search_col.text_input("搜尋使用者名稱（前綴）", key="admin_search").strip()
+    membership = membership_col.selectbox("會員類型", ["全部", "free", "premium"], key="admin_membership")
+    role = role_col.selectbox("角色", ["全部", "user", "admin"], key="admin_role")
+
+    # 筛选条件改变时回到第一页；admin_cursors 记录每一页开始前的最后一个用户名
+    filters = (search, membership, role)
+    if st.session_state.get('admin_filters') != filters:
+        st.session_state['admin_filters'] = filters
+        st.session_state['admin_cursors'] = [None]
+    st.session_state.setdefault('admin_table_version', 0)
+    cursors = st.session_state['admin_cursors']
+
+    # 多查一个用户，用来判断是否还有下一页
+    users = list_users(after=cursors[-1], search=search,
+                       membership=None if membership == "全部" else membership,
+                       role=None if role == "全部" else role,
+                       limit=ADMIN_PAGE_SIZE + 1)
+    has_next = len(users) > ADMIN_PAGE_SIZE
+    users = users[:ADMIN_PAGE_SIZE]
+
+    table = pd.DataFrame([{
+        '選取': False,
+        '使用者名稱': user[0],
+        '會員類型': user[2],
+        '角色': user[3],
+        '點數': user[4] if user[4] else 0,
+        '會員到期時間': user[5] if user[5] else "無",
+        '免費使用次數': str(user[6]) if user[6] is not None else "無",
+    } for user in users], columns=['選取', '使用者名稱', '會員類型', '角色', '點數', '會員到期時間', '免費使用次數'])
+    edited = st.data_editor(table, hide_index=True, use_container_width=True,
+                            disabled=[column for column in table.columns if column != '選取'],
+                            key=f"admin_table_{st.session_state['admin_table_version']}_{len(cursors)}")
+    selected = edited.loc[edited['選取'], '使用者名稱'].tolist()
+
+    prev_col, page_col, next_col = st.columns([1, 2, 1])
+    if prev_col.button("上一頁", key="admin_prev_page", disabled=len(cursors) == 1):
+        cursors.pop()
+        st.experimental_rerun()
+    page_col.write(f"第 {len(cursors)} 頁，已選取 {len(selected)} 位用戶")
+    if next_col.button("下一頁", key="admin_next_page", disabled=not has_next):
+        cursors.append(users[-1][0])
+        st.experimental_rerun()
+
+    # 批量操作：每个操作在一个事务中完成
+    amount = st.number_input("增加點數", min_value=1, max_value=1000, value=100, key="admin_credit_amount")
+    delete_col, reset_col, credit_col = st.columns(3)
+    if delete_col.button("刪除所選用戶", key="bulk_delete_button", disabled=not selected):
+        deleted = delete_users(selected)
+        st.session_state['admin_table_version'] += 1
+        st.success(f"已刪除 {deleted} 位使用者（管理者不會被刪除）。")
+        st.experimental_rerun()
+    if reset_col.button("重置所選用戶的免費次數", key="bulk_reset_button", disabled=not selected):
+        reset_free_uses_for(selected)
+        st.session_state['admin_table_version'] += 1
+        st.success(f"已重置 {len(selected)} 位使用者的免費次數。")
+        st.experimental_rerun()
+    if credit_col.button("為所選用戶增加點數", key="bulk_credit_button", disabled=not selected):
+        add_credits_to(selected, amount)
+        st.session_state['admin_table_version'] += 1
+        st.success(f"已為 {len(selected)} 位使用者增加 {amount} 點數。")
+        st.experimental_rerun()
+
     if st.button("重置所有免費用戶的使用次數", key="reset_all_button"):
-        reset_free_uses()
+        reset_all_free_uses()
         st.success("所有免費用戶的使用次數已重置。")
         st.experimental_rerun()
 
+    with st.expander("診斷資訊"):
+        diagnostics_panel()
+
     if st.button("登出", key="admin_logout_button"):
         st.session_state['logged_in'] = False
         st.session_state['username'] = ""
@@ -287,43 +279,207 @@ def admin_page():
         st.session_state['free_uses'] = 5
         st.experimental_rerun()
 
-# 获取所有用户
-def get_all_users():
-    c.execute("SELECT * FROM users")
-    return c.fetchall()
+# 诊断面板（仅管理员）：各阶段耗时、计数器、缓存与任务队列统计，以及 cProfile 分析
+def diagnostics_panel():
+    data = snapshot()
+    components = component_stats()
+    jobs = components['ocr_jobs']
+    image_cache = components['image_cache']
+    ocr_cache = components['ocr_cache']
+    lookups = image_cache['hits'] + image_cache['misses']
+    ocr_lookups = data['counters'].get('ocr_cache_hits', 0) + data['counters'].get('ocr_cache_misses', 0)
+    columns = st.columns(4)
+    columns[0].metric("執行次數", data['counters'].get('reruns', 0))
+    columns[1].metric("OCR 佇列", f"{jobs['queued']} 等待 / {jobs['running']} 執行中")
+    columns[2].metric("頁面快取命中率", f"{image_cache['hits'] / lookups:.0%}" if lookups else "無")
+    columns[3].metric("OCR 快取命中率", f"{data['counters'].get('ocr_cache_hits', 0) / ocr_lookups:.0%}" if ocr_lookups else "無")
+
+    st.write("各階段耗時")
+    st.dataframe(pd.DataFrame([{
+        '階段': name,
+        '次數': stat['count'],
+        '平均 (ms)': round(stat['sum'] / stat['count'] * 1000, 2),
+        '最長 (ms)': round(stat['max'] * 1000, 2),
+        '總計 (s)': round(stat['sum'], 3),
+    } for name, stat in sorted(data['spans'].items(), key=lambda item: -item[1]['sum'])],
+        columns=['階段', '次數', '平均 (ms)', '最長 (ms)', '總計 (s)']), hide_index=True, use_container_width=True)
+    st.write("計數器")
+    st.json(data['counters'])
+    st.write("快取與佇列")
+    st.json({name: {k: v for k, v in stats.items() if k != 'sessions'} for name, stats in components.items()})
+    st.write("各 session 的頁面記憶體")
+    st.dataframe(pd.DataFrame([{
+        '用戶': session['name'],
+        '編號': session['id'],
+        '常駐 (MB)': round(session['resident_bytes'] / 1e6, 1),
+        '常駐頁數': session['resident_pages'],
+        '換出 (MB)': round(session['spilled_bytes'] / 1e6, 1),
+        '換出頁數': session['spilled_pages'],
+    } for session in sorted(components['page_store']['sessions'], key=lambda item: -item['resident_bytes'])],
+        columns=['用戶', '編號', '常駐 (MB)', '常駐頁數', '換出 (MB)', '換出頁數']), hide_index=True, use_container_width=True)
+    st.caption(f"OCR 結果快取：{ocr_cache['entries']} 筆，{ocr_cache['bytes'] / 1e6:.1f} MB")
+
+    export_col, reset_col, reload_col = st.columns(3)
+    export_col.download_button("下載 Prometheus 指標", render_prometheus(components), file_name="metrics.prom",
+                               mime="text/plain", key="metrics_download")
+    if reset_col.button("重置統計", key="metrics_reset_button"):
+        reset_metrics()
+        st.experimental_rerun()
+    if reload_col.button("重新載入 OCR 模型", key="reload_models_button"):
+        get_job_manager().reload_models()
+        st.success("已重新啟動 OCR 工作進程，模型將重新載入")
+
+    # cProfile 分析任何用户（包括自己）的下一次执行
+    if st.button("分析下一次執行（cProfile）", key="profile_button", disabled=profile_requested()):
+        request_profile()
+    if profile_requested():
+        st.info("等待下一次執行以進行分析…")
+    profile = last_profile()
+    if profile is not None:
+        st.write(f"最近一次分析：{profile['label']}，{profile['time']}，耗時 {profile['seconds']:.2f} 秒")
+        st.code(profile['text'])
+        st.download_button("下載分析結果（.prof）", profile['data'], file_name="profile.prof",
+                           mime="application/octet-stream", key="profile_download")
 
 # 受保护内容
 def protected_content():
     st.write("這裡是可以上傳PDF檔案並處理的部分")
     uploaded_file = st.file_uploader("上傳PDF文件", type="pdf")
     if uploaded_file is not None:
+        dpi = st.selectbox("頁面解析度（DPI）", DPI_CHOICES,
+                           index=DPI_CHOICES.index(RENDER_DPI) if RENDER_DPI in DPI_CHOICES else 0, key='render_dpi')
         with st.spinner("正在加载PDF文件..."):
-            images = read_pdf(uploaded_file)
+            pages = read_pdf(uploaded_file, dpi)
         
         st.write("PDF檔案已成功讀取！請選擇您要處理的頁面：")
         
         if 'ocr_results' not in st.session_state:
             st.session_state.ocr_results = {}
+
+        if 'ocr_jobs' not in st.session_state:
+            st.session_state.ocr_jobs = {}
         
-        if 'updated_images' not in st.session_state:
-            st.session_state.updated_images = [None] * len(images)
+        if 'page_edits' not in st.session_state:
+            st.session_state.page_edits = {}
+
+        if 'page_store' not in st.session_state:
+            st.session_state.page_store = PageStore(name=st.session_state['username'])
+
+        # 换了一份PDF或解析度时清空上一份文件的识别结果和编辑（识别结果的坐标与解析度有关）
+        if st.session_state.get('pdf_key') != (pages.digest, pages.dpi):
+            st.session_state.pdf_key = (pages.digest, pages.dpi)
+            st.session_state.page_select = 0
+            discard_export()
+            discard_ocr_jobs()
+            st.session_state.ocr_results = {}
+            st.session_state.page_edits = {}
+            st.session_state.page_store.clear()
+
+        # 缩略图在后台生成
+        pages.start_thumbnails()
 
-        image_options = [f"第 {i + 1} 頁" for i in range(len(images))]
-        selected_page = st.selectbox("選擇頁面", image_options)
-        page_idx = image_options.index(selected_page)
+        jobs = poll_ocr_jobs()
 
-        if st.session_state.updated_images[page_idx] is None:
-            st.session_state.updated_images[page_idx] = images[page_idx]
+        page_idx = st.selectbox("選擇頁面", range(len(pages)), format_func=lambda i: f"第 {i + 1} 頁", key='page_select')
+        page_strip(pages, page_idx)
 
-        display_page(st.session_state.updated_images[page_idx], page_idx)
+        # 放在选页框之后：其中的 rerun 会清除尚未绘制的组件的状态（选页框会回到第 1 页）
+        ocr_all_pages(pages)
 
-def display_page(image, idx):
+        display_page(pages, page_idx, jobs)
+        # 浏览当前页时在后台预先解码前后两页，切换页面时无需等待
+        pages.prefetch([page_idx + 1, page_idx - 1])
+
+        export_section(pages)
+
+        # 任务仍在进行时定时刷新页面
+        if st.session_state.ocr_jobs or 'ocr_batch_job' in st.session_state:
+            time.sleep(1)
+            st.experimental_rerun()
+
+# 读取页面的文字层作为识别结果；没有文字层时返回 False
+def load_text_layer(pages, idx):
+    if not pages.has_text(idx):
+        return False
+    st.session_state.ocr_results[idx] = build_text_boxes(pages.text_results(idx))
+    return True
+
+# 跳转到指定页面（按钮回调，在下一次运行前修改选择框的值）
+def go_to_page(idx):
+    st.session_state.page_select = idx
+
+# 缩略图导航条：显示当前页附近的缩略图，点击页码跳转
+def page_strip(pages, page_idx):
+    start = max(0, min(page_idx - THUMBNAIL_STRIP_SIZE // 2, len(pages) - THUMBNAIL_STRIP_SIZE))
+    columns = st.columns(THUMBNAIL_STRIP_SIZE)
+    for column, idx in zip(columns, range(start, len(pages))):
+        column.image(pages.thumbnail(idx), use_column_width=True)
+        column.button(f"{idx + 1}", key=f'thumbnail_button_{idx}', on_click=go_to_page, args=(idx,),
+                      disabled=idx == page_idx, use_container_width=True)
+
+# 识别整份文件，结果逐页写入 ocr_results；有文字层的页面直接读取，不送去识别
+def ocr_all_pages(pages):
+    manager = get_job_manager()
+    job_id = st.session_state.get('ocr_batch_job')
+    if job_id is None:
+        if st.button("識別全部頁面", key='ocr_all_button'):
+            todo = [i for i in range(len(pages)) if not load_text_layer(pages, i)]
+            if not todo:
+                st.experimental_rerun()
+            try:
+                st.session_state.ocr_batch_job = manager.submit_batch(st.session_state['username'], pages, todo)
+            except JobLimitError:
+                st.warning("您排隊中的識別任務過多，請等待目前的任務完成")
+            else:
+                st.experimental_rerun()
+        return
+
+    job = manager.poll(job_id)
+    if job is None:
+        del st.session_state['ocr_batch_job']
+        st.error("識別任務已失效，請重新識別")
+        return
+    st.session_state.ocr_results.update(job['results'])
+    if job['status'] in ('queued', 'running'):
+        st.progress(job['done'] / job['total'], text=f"正在識別全部頁面：{job['done']} / {job['total']}")
+        if st.button("取消識別全部頁面", key='cancel_ocr_all_button'):
+            manager.cancel(job_id)
+    else:
+        del st.session_state['ocr_batch_job']
+        manager.forget(job_id)
+        if job['error']:
+            st.error(f"部分頁面識別失敗：{job['error']}")
+        elif job['status'] == 'done':
+            st.success(f"全部 {job['total']} 頁識別完成")
+
+def display_page(pages, idx, jobs):
+    base = pages[idx]
+    edits = st.session_state.page_edits.get(idx)
+    image = edits.render(base) if edits is not None else base
     st.image(image, caption=f"第 {idx + 1} 頁", use_column_width=True)
 
-    if st.button(f"識別第 {idx + 1} 頁文字", key=f'ocr_button_{idx}'):
-        ocr_results = perform_ocr(image)
-        st.session_state.ocr_results[idx] = ocr_results
-        st.experimental_rerun()
+    # 页面自带文字层时直接使用，无需 OCR
+    if pages.has_text(idx):
+        if idx not in st.session_state.ocr_results:
+            load_text_layer(pages, idx)
+        st.caption("此頁含有文字層，已直接讀取其中的文字")
+
+    job = jobs.get(idx)
+    if job is None:
+        if st.button(f"識別第 {idx + 1} 頁文字", key=f'ocr_button_{idx}'):
+            try:
+                st.session_state.ocr_jobs[idx] = get_job_manager().submit(st.session_state['username'], image)
+            except JobLimitError:
+                st.warning("您排隊中的識別任務過多，請等待目前的任務完成")
+            else:
+                st.experimental_rerun()
+    else:
+        if job['status'] == 'queued':
+            st.info(f"第 {idx + 1} 頁正在排隊識別，前面還有 {job['position']} 個任務")
+        else:
+            st.info(f"正在識別第 {idx + 1} 頁文字，已用時 {int(time.time() - job['started'])} 秒")
+        if st.button(f"取消識別第 {idx + 1} 頁", key=f'cancel_ocr_button_{idx}'):
+            get_job_manager().cancel(job['id'])
 
     if idx in st.session_state.ocr_results:
         for obj_idx, (bbox, text, font_size) in enumerate(st.session_state.ocr_results[idx]):
@@ -333,151 +489,102 @@ def display_page(image, idx):
             thickness = st.slider("選擇文字粗細度", 1, 10, 2, key=f"thickness_slider_{idx}_{obj_idx}")
 
             if st.button(f"在圖片上更新第 {idx + 1} 頁第 {obj_idx + 1} 區域的文字", key=f"update_button_{idx}_{obj_idx}"):
-                update_text_in_image(image, idx, obj_idx, editable_text, font_size, thickness)
+                update_text_in_image(base, idx, obj_idx, editable_text, font_size, thickness)
                 st.experimental_rerun()
 
+    if edits is not None and (edits.can_undo() or edits.can_redo()):
+        undo_col, redo_col = st.columns(2)
+        if undo_col.button("復原", key=f'undo_button_{idx}', disabled=not edits.can_undo()):
+            edits.undo(base)
+            st.experimental_rerun()
+        if redo_col.button("重做", key=f'redo_button_{idx}', disabled=not edits.can_redo()):
+            edits.redo(base)
+            st.experimental_rerun()
+
     if st.button(f"重新載入第 {idx + 1} 頁", key=f'reload_button_{idx}'):
-        if st.session_state['free_uses'] > 0:
-            st.session_state.updated_images[idx] = None
-            st.session_state['free_uses'] -= 1
-            update_free_uses(st.session_state['username'], st.session_state['free_uses'])
+        remaining = consume_free_use(st.session_state['username'])
+        if remaining is not None:
+            edits = st.session_state.page_edits.pop(idx, None)
+            if edits is not None:
+                edits.clear()
+            st.session_state['free_uses'] = remaining
             st.experimental_rerun()
         else:
             st.warning("您的免費次數已用完。請儲值以獲得更多次數或升級至付費會員")
 
-# 读取PDF文件并返回所有页面的图像
-def read_pdf(file):
-    pdf_document = fitz.open(stream=file.read(), filetype="pdf")
-    images = []
-
-    for page_num in range(len(pdf_document)):
-        page = pdf_document.load_page(page_num)
-        image_list = page.get_images(full=True)
-        for img in image_list:
-            xref = img[0]
-            base_image = pdf_document.extract_image(xref)
-            image_bytes = base_image["image"]
-            image_ext = base_image["ext"]
-            image = Image.open(io.BytesIO(image_bytes))
-            images.append(image)
-    
-    return images
-
-# 执行OCR识别
-def perform_ocr(image):
-    im = image.filter(ImageFilter.MedianFilter())
-    enhancer = ImageEnhance.Contrast(im)
-    im = enhancer.enhance(2)
-    im = im.convert('L')
-    image_np = np.array(im)
-    results = reader.readtext(image_np, detail=1)
-    text_boxes = []
-
-    # 合并接近的文字区域
-    merged_boxes = []
-    current_box = None
-    for result in results:
-        bbox, text, _ = result
-        if current_box is None:
-            current_box = bbox
-            merged_text = text
-        else:
-            if is_close(current_box, bbox):
-                current_box = merge_boxes(current_box, bbox)
-                merged_text += " " + text
+# 删除上一次导出的文件
+def discard_export():
+    export = st.session_state.pop('export_file', None)
+    if export is not None:
+        export.discard()
+
+# 把编辑后的页面导出为新的 PDF（逐页写入临时文件）并提供下载
+def export_section(pages):
+    with st.expander("匯出 PDF"):
+        mode = st.radio("編輯過的區域", ["text", "image"], key='export_mode',
+                        format_func=lambda m: "以文字物件輸出（可搜尋、可選取）" if m == "text" else "以圖片輸出（與畫面一致）")
+        text_layer = st.checkbox("加入辨識文字層（讓掃描頁面可以搜尋）", value=True, key='export_text_layer')
+        if st.button("產生 PDF", key='export_button'):
+            discard_export()
+            progress = st.progress(0.0, text="正在匯出...")
+            export = ExportFile()
+            try:
+                export_pdf(pages, export.path, st.session_state.page_edits, st.session_state.ocr_results, mode, text_layer,
+                           progress=lambda done, total: progress.progress(done / total, text=f"正在匯出：{done} / {total}"))
+            except Exception as e:
+                export.discard()
+                st.error(f"匯出失敗：{e}")
             else:
-                merged_boxes.append((current_box, merged_text))
-                current_box = bbox
-                merged_text = text
-    if current_box is not None:
-        merged_boxes.append((current_box, merged_text))
-
-    for bbox, text in merged_boxes:
-        font_size = estimate_font_size(bbox)
-        text_boxes.append((bbox, text, font_size))
-
-    return text_boxes
-
-# 判断两个矩形框是否接近
-def is_close(box1, box2, threshold=10):
-    box1_x_center = (box1[0][0] + box1[2][0]) / 2
-    box1_y_center = (box1[0][1] + box1[2][1]) / 2
-    box2_x_center = (box2[0][0] + box2[2][0]) / 2
-    box2_y_center = (box2[0][1] + box2[2][1]) / 2
-
-    distance = np.sqrt((box1_x_center - box2_x_center) ** 2 + (box1_y_center - box2_y_center) ** 2)
-    return distance < threshold
-
-# 合并两个矩形框
-def merge_boxes(box1, box2):
-    x_coords = [box1[i][0] for i in range(4)] + [box2[i][0] for i in range(4)]
-    y_coords = [box1[i][1] for i in range(4)] + [box2[i][1] for i in range(4)]
-    return [(min(x_coords), min(y_coords)), (max(x_coords), min(y_coords)), (max(x_coords), max(y_coords)), (min(x_coords), max(y_coords))]
-
-# 估算字体大小
-def estimate_font_size(bbox):
-    if not bbox:
-        return 1
-    height = np.linalg.norm(np.array(bbox[0]) - np.array(bbox[3]))
-    return max(1, int(height / 2))
-
-# 更新图片上的文字
-def update_text_in_image(image, page_idx, obj_idx, text, font_size, thickness):
+                st.session_state.export_file = export
+        export = st.session_state.get('export_file')
+        if export is not None:
+            with export.open() as f:
+                st.download_button(f"下載 PDF（{export.size() / 1e6:.1f} MB）", f, file_name="edited.pdf",
+                                   mime="application/pdf", key='export_download_button')
+
+# 查询OCR任务，完成后把结果写入 ocr_results
+def poll_ocr_job(idx, job_id):
+    manager = get_job_manager()
+    job = manager.poll(job_id)
+    if job is None or job['status'] in ('done', 'failed', 'cancelled'):
+        del st.session_state.ocr_jobs[idx]
+        manager.forget(job_id)
+        if job is None:
+            st.error("識別任務已失效，請重新識別")
+        elif job['status'] == 'done':
+            st.session_state.ocr_results[idx] = job['result']
+        elif job['status'] == 'failed':
+            st.error(f"識別第 {idx + 1} 頁失敗：{job['error']}")
+    return job
+
+# 取消并删除上一份文件的所有识别任务（单页和整份文件），避免结果写入新文件
+def discard_ocr_jobs():
+    manager = get_job_manager()
+    job_ids = list(st.session_state.pop('ocr_jobs', {}).values())
+    if 'ocr_batch_job' in st.session_state:
+        job_ids.append(st.session_state.pop('ocr_batch_job'))
+    for job_id in job_ids:
+        manager.cancel(job_id)
+        manager.forget(job_id)
+    st.session_state.ocr_jobs = {}
+
+# 查询所有单页识别任务（不只是当前页），取走已结束任务的结果；返回仍在进行的任务 {页码: 任务}
+def poll_ocr_jobs():
+    jobs = {}
+    for idx, job_id in list(st.session_state.ocr_jobs.items()):
+        job = poll_ocr_job(idx, job_id)
+        if job is not None and job['status'] in ('queued', 'running'):
+            jobs[idx] = job
+    return jobs
+
+# 更新图片上的文字（只记录覆盖层并局部重绘）
+@timed('edit.update_text')
+def update_text_in_image(base, page_idx, obj_idx, text, font_size, thickness):
     bbox = st.session_state.ocr_results[page_idx][obj_idx][0]
-    left = min(bbox[0][0], bbox[3][0])
-    top = min(bbox[0][1], bbox[1][1])
-    right = max(bbox[1][0], bbox[2][0])
-    bottom = max(bbox[2][1], bbox[3][1])
-    width = right - left
-    height = bottom - top
-
-    cv_image = np.array(image)
-    cv_image = cv2.cvtColor(cv_image, cv2.COLOR_RGB2BGR)
-    
-    # 删除原来的区域
-    cv2.rectangle(cv_image, (int(left), int(top)), (int(right), int(bottom)), (255, 255, 255), -1)
-    
-    # 添加新的文本
-    font = cv2.FONT_HERSHEY_SIMPLEX
-    color = (0, 0, 0)
-
-    # 计算新的文本位置
-    text_x = int(left)
-    text_y = int(top + font_size)
-
-    wrapped_text = wrap_text(text, width, font_size)
-    for line in wrapped_text:
-        cv2.putText(cv_image, line, (text_x, text_y), font, font_size / 10, color, thickness)
-        text_y += int(font_size * 3)
-
-    pil_image = Image.fromarray(cv2.cvtColor(cv_image, cv2.COLOR_BGR2RGB))
-    st.session_state.updated_images[page_idx] = pil_image
-
-# 将文本分行
-def wrap_text(text, max_width, font_size):
-    lines = []
-    current_line = ""
-    current_width = 0
-    space_width = font_size / 2
-
-    for char in text:
-        if char == '\n':
-            lines.append(current_line)
-            current_line = ""
-            current_width = 0
-        else:
-            char_width = font_size / 2
-            if current_width + char_width > max_width:
-                lines.append(current_line)
-                current_line = char
-                current_width = char_width
-            else:
-                current_line += char
-                current_width += char_width
-
-    if current_line:
-        lines.append(current_line)
-    return lines
+    edits = st.session_state.page_edits.get(page_idx)
+    if edits is None:
+        edits = st.session_state.page_edits[page_idx] = PageEdits(st.session_state.page_store, page_idx)
+    edits.add(base, make_overlay(bbox, text, font_size, thickness))
 
 # 添加初始管理员
 def add_initial_admin():
@@ -499,17 +606,10 @@ def validate_expiry_date(expiry_date):
 def validate_cvv(cvv):
     return cvv.isdigit() and len(cvv) == 3
 
-# 更新点数
-def update_credits(username, amount):
-    c.execute("UPDATE users SET credits = credits + ? WHERE username = ?", (amount, username))
-    conn.commit()
-
-# 重置所有免费用户的使用次数
-def reset_free_uses():
-    c.execute("UPDATE users SET free_uses = 5, last_reset = ? WHERE membership = 'free'", (datetime.now().strftime('%Y-%m-%d'),))
-    conn.commit()
-
 if __name__ == "__main__":
-    add_initial_admin()
+    # 数据库迁移和初始管理员只在进程启动后的第一次运行时执行
+    if init_db():
+        add_initial_admin()
+    get_job_manager().warm_up()
     main()
-    conn.close()
+    mark_startup_complete()
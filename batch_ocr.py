@@ -0,0 +1,211 @@
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+import ocr_engine
+from ocr_jobs import BATCH_PAGES, OCR_WORKERS, init_worker
+from pdf_pages import read_pdf, RENDER_DPI
+from pdf_export import export_pdf
+
+logger = logging.getLogger(__name__)
+
+# 记录已完成文件的进度文件（位于输出目录中），用于中断后继续处理
+PROGRESS_FILE = '.batch_progress.jsonl'
+OUTPUT_FORMATS = ('jsonl', 'pdf')
+
+# 收集要处理的 PDF：目录按递归查找，输出文件名保留相对于该目录的路径
+def collect_inputs(inputs):
+    found = []
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, _, files in os.walk(item):
+                for name in sorted(files):
+                    if name.lower().endswith('.pdf'):
+                        path = os.path.join(root, name)
+                        found.append((path, os.path.relpath(path, item)))
+        else:
+            found.append((item, os.path.basename(item)))
+    return found
+
+# 文件的进度键：相对路径 + 大小 + 修改时间 + 输出选项（格式、解析度、文字层、OCR 参数），文件或选项变化后会重新处理
+def progress_key(path, relname, options):
+    stat = os.stat(path)
+    digest = hashlib.sha256(json.dumps(options, sort_keys=True).encode()).hexdigest()[:16]
+    return f"{relname}:{stat.st_size}:{stat.st_mtime_ns}:{digest}"
+
+# 文件的输出路径：保留相对路径，扩展名换成输出格式
+def output_path(output_dir, relname, fmt):
+    return os.path.join(output_dir, os.path.splitext(relname)[0] + '.' + fmt)
+
+# 读取已完成的文件
+def load_progress(output_dir):
+    done = set()
+    path = os.path.join(output_dir, PROGRESS_FILE)
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    done.add(json.loads(line)['key'])
+                except (ValueError, KeyError):
+                    # 最后一行可能因中断而不完整
+                    continue
+    return done
+
+def _append_progress(output_dir, record):
+    with open(os.path.join(output_dir, PROGRESS_FILE), 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+def _json_box(bbox, text, font_size):
+    return {'bbox': [[float(x), float(y)] for x, y in bbox], 'text': text, 'font_size': int(font_size)}
+
+# 识别一份 PDF：有文字层的页面直接读取，其余页面按 BATCH_PAGES 一批送入 OCR
+# 返回 {页码: (来源, [(bbox, text, font_size)])}，来源为 'text' 或 'ocr'
+def ocr_pdf(pages, text_layer=True, **ocr_kwargs):
+    results = {}
+    todo = []
+    for idx in range(len(pages)):
+        if text_layer and pages.has_text(idx):
+            results[idx] = ('text', ocr_engine.build_text_boxes(pages.text_results(idx)))
+        else:
+            todo.append(idx)
+    for start in range(0, len(todo), BATCH_PAGES):
+        chunk = todo[start:start + BATCH_PAGES]
+        for idx, text_boxes in zip(chunk, ocr_engine.perform_ocr_batch([pages[i] for i in chunk], **ocr_kwargs)):
+            results[idx] = ('ocr', text_boxes)
+    return results
+
+# 写出 JSONL：每页一行
+def write_jsonl(path, relname, results):
+    with open(path, 'w', encoding='utf-8') as f:
+        for idx in sorted(results):
+            source, text_boxes = results[idx]
+            record = {'file': relname, 'page': idx + 1, 'source': source,
+                      'boxes': [_json_box(*box) for box in text_boxes]}
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+# 处理单个文件并写出结果（先写临时文件再改名，中断时不会留下不完整的结果）
+def process_file(path, relname, output_dir, fmt='jsonl', dpi=RENDER_DPI, text_layer=True, **ocr_kwargs):
+    start = time.perf_counter()
+    with open(path, 'rb') as f:
+        pages = read_pdf(f, dpi, cache=False)
+    try:
+        results = ocr_pdf(pages, text_layer, **ocr_kwargs)
+        output = output_path(output_dir, relname, fmt)
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+        tmp_path = output + '.partial'
+        if fmt == 'pdf':
+            export_pdf(pages, tmp_path, ocr_results={idx: boxes for idx, (_, boxes) in results.items()}, text_layer=True)
+        else:
+            write_jsonl(tmp_path, relname, results)
+        os.replace(tmp_path, output)
+    finally:
+        pages.close()
+    return {
+        'file': relname,
+        'output': output,
+        'pages': len(results),
+        'ocr_pages': sum(1 for source, _ in results.values() if source == 'ocr'),
+        'seconds': time.perf_counter() - start,
+    }
+
+def _process(path, relname, key, output_dir, options):
+    summary = process_file(path, relname, output_dir, **options)
+    summary['key'] = key
+    return summary
+
+# 批量处理 PDF；workers 个进程各自加载模型（每个进程一份，内存随进程数增加），线程数平分 CPU
+# resume=True 时跳过进度文件中以相同选项完成、且输出文件仍在的文件；返回处理统计（含每秒页数）
+def run_batch(inputs, output_dir, workers=OCR_WORKERS, fmt='jsonl', resume=True, dpi=RENDER_DPI, text_layer=True, **ocr_kwargs):
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(f"不支持的输出格式: {fmt}")
+    os.makedirs(output_dir, exist_ok=True)
+    if not resume and os.path.exists(os.path.join(output_dir, PROGRESS_FILE)):
+        os.remove(os.path.join(output_dir, PROGRESS_FILE))
+    done = load_progress(output_dir) if resume else set()
+
+    options = dict(fmt=fmt, dpi=dpi, text_layer=text_layer, **ocr_kwargs)
+    tasks = []
+    skipped = 0
+    for path, relname in collect_inputs(inputs):
+        key = progress_key(path, relname, options)
+        if key in done and os.path.exists(output_path(output_dir, relname, fmt)):
+            skipped += 1
+        else:
+            tasks.append((path, relname, key))
+    logger.info("待处理 %d 个文件，跳过已完成的 %d 个", len(tasks), skipped)
+
+    stats = {'files': 0, 'failed': [], 'skipped': skipped, 'pages': 0, 'ocr_pages': 0}
+    if not tasks:
+        # 没有要处理的文件时不加载模型
+        stats.update(seconds=0.0, pages_per_second=0.0)
+        return stats
+    start = time.perf_counter()
+    # 工作进程预先加载本次使用的模型（语言、解码选项）
+    model_kwargs = {k: v for k, v in ocr_kwargs.items() if k in ('langs', 'decoder', 'beam_width')}
+
+    def finish(relname, summary=None, error=None):
+        if error is not None:
+            logger.error("处理 %s 失败: %s", relname, error)
+            stats['failed'].append(relname)
+            return
+        _append_progress(output_dir, summary)
+        stats['files'] += 1
+        stats['pages'] += summary['pages']
+        stats['ocr_pages'] += summary['ocr_pages']
+        logger.info("[%d/%d] %s: %d 页（OCR %d 页），%.1fs", stats['files'] + len(stats['failed']), len(tasks),
+                    relname, summary['pages'], summary['ocr_pages'], summary['seconds'])
+
+    if workers <= 1:
+        init_worker(os.cpu_count() or 1, **model_kwargs)
+        for path, relname, key in tasks:
+            try:
+                finish(relname, _process(path, relname, key, output_dir, options))
+            except Exception as e:
+                finish(relname, error=e)
+    else:
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=partial(init_worker, **model_kwargs), initargs=(threads,)) as executor:
+            futures = {executor.submit(_process, path, relname, key, output_dir, options): relname
+                       for path, relname, key in tasks}
+            for future in as_completed(futures):
+                try:
+                    finish(futures[future], future.result())
+                except Exception as e:
+                    finish(futures[future], error=e)
+
+    stats['seconds'] = time.perf_counter() - start
+    stats['pages_per_second'] = stats['pages'] / stats['seconds'] if stats['seconds'] > 0 else 0.0
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description="批量识别 PDF（不需要 Streamlit），输出 JSONL 或带文字层的 PDF")
+    parser.add_argument('inputs', nargs='+', help="PDF 文件或目录（递归查找 *.pdf）")
+    parser.add_argument('-o', '--output', required=True, help="输出目录")
+    parser.add_argument('-w', '--workers', type=int, default=OCR_WORKERS, help="工作进程数（每个进程各加载一份模型）")
+    parser.add_argument('-f', '--format', choices=OUTPUT_FORMATS, default='jsonl')
+    parser.add_argument('--dpi', type=int, default=RENDER_DPI, help="页面栅格化解析度")
+    parser.add_argument('--no-text-layer', action='store_true', help="忽略 PDF 自带的文字层，所有页面都做 OCR")
+    parser.add_argument('--restart', action='store_true', help="忽略进度文件，全部重新处理")
+    parser.add_argument('--langs', default=','.join(ocr_engine.DEFAULT_LANGS), help="OCR 语言，以逗号分隔")
+    parser.add_argument('--decoder', default=ocr_engine.DEFAULT_DECODER)
+    parser.add_argument('--beam-width', type=int, default=ocr_engine.DEFAULT_BEAM_WIDTH)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    stats = run_batch(args.inputs, args.output, workers=args.workers, fmt=args.format, resume=not args.restart,
+                      dpi=args.dpi, text_layer=not args.no_text_layer,
+                      langs=tuple(args.langs.split(',')), decoder=args.decoder, beam_width=args.beam_width)
+    print(f"完成 {stats['files']} 个文件，{stats['pages']} 页（OCR {stats['ocr_pages']} 页），"
+          f"跳过 {stats['skipped']} 个，失败 {len(stats['failed'])} 个")
+    print(f"耗时 {stats['seconds']:.1f}s，吞吐量 {stats['pages_per_second']:.2f} 页/秒")
+    if stats['failed']:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
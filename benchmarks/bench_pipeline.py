@@ -0,0 +1,294 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+import cv2
+import fitz  # PyMuPDF
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import ocr_engine
+import pdf_pages
+from page_edits import PageEdits, make_overlay
+from pdf_export import export_pdf
+from text_render import wrap_text
+from bench_preprocess import _rss_bytes
+
+ENGLISH_LINE = "The quick brown fox jumps over the lazy dog 0123456789"
+CJK_LINE = "基於Streamlit的PDF圖片提取 並進行編輯 OCR 文字辨識 測試"
+KINDS = ('scanned', 'vector', 'cjk')
+
+# 生成一页文字（矢量），CJK 文字使用 PyMuPDF 内置字体
+def _write_text_page(page, line, fontname):
+    y = 60
+    while y < page.rect.height - 40:
+        page.insert_text((50, y), line, fontsize=11, fontname=fontname)
+        y += 22
+
+# 生成测试用的 PDF：scanned 为整页扫描图片，vector 为英文文字页，cjk 为中英混排文字页
+def make_pdfs(directory, pages, scan_dpi=200):
+    paths = {}
+    for kind in KINDS:
+        doc = fitz.open()
+        for i in range(pages):
+            page = doc.new_page(width=595, height=842)
+            if kind == 'scanned':
+                source = fitz.open()
+                _write_text_page(source.new_page(width=595, height=842), f"{ENGLISH_LINE} {i}", 'helv')
+                pix = source[0].get_pixmap(dpi=scan_dpi)
+                page.insert_image(page.rect, stream=pix.tobytes('png'))
+                source.close()
+            else:
+                line = CJK_LINE if kind == 'cjk' else ENGLISH_LINE
+                _write_text_page(page, f"{line} {i}", 'china-s' if kind == 'cjk' else 'helv')
+                page.draw_rect(fitz.Rect(40, 40, 555, 802), color=(0, 0, 0))
+        paths[kind] = os.path.join(directory, f"{kind}.pdf")
+        doc.save(paths[kind], deflate=True)
+        doc.close()
+    return paths
+
+# 固定的假识别器：按网格返回单词框，使合并及之后的阶段有稳定、可重复的输入
+class StubReader:
+    def readtext(self, image, detail=1, **kwargs):
+        height, width = image.shape[:2]
+        results = []
+        for y in range(10, height - 30, 40):
+            for x in range(10, width - 70, 70):
+                results.append(([[x, y], [x + 60, y], [x + 60, y + 20], [x, y + 20]], f"w{x}_{y}", 0.9))
+        return results
+
+    def readtext_batched(self, images, detail=1, **kwargs):
+        return [self.readtext(image) for image in images]
+
+def _prepare_ocr(ctx):
+    if ctx['ocr'] == 'stub':
+        ocr_engine._models[ocr_engine.model_key()] = {'reader': StubReader(), 'readtext_kwargs': {}}
+    else:
+        ocr_engine.get_model()
+
+# 打开所有测试 PDF，关闭图片缓存（预算为 0 时只保留最近一张），每次都重新解码
+def _open_all(ctx):
+    pdf_pages.image_cache.set_budget(0)
+    pdf_pages.thumbnail_cache.set_budget(0)
+    return [pdf_pages.read_pdf(open(path, 'rb'), ctx['dpi'], cache=False) for path in ctx['pdfs'].values()]
+
+def _all_images(ctx):
+    return [pages[i] for pages in _open_all(ctx) for i in range(len(pages))]
+
+# 各阶段：返回 (被测函数, 处理的项目数)；准备工作不计入测量
+def stage_read_pdf(ctx):
+    datas = [open(path, 'rb').read() for path in ctx['pdfs'].values()]
+
+    def run():
+        for data in datas:
+            pdf_pages.read_pdf(data, ctx['dpi'], cache=False).close()
+    return run, len(datas) * ctx['pages']
+
+def stage_rasterize(ctx):
+    documents = _open_all(ctx)
+
+    def run():
+        for pages in documents:
+            for i in range(len(pages)):
+                pages[i]
+    return run, len(documents) * ctx['pages']
+
+def stage_thumbnails(ctx):
+    documents = _open_all(ctx)
+
+    def run():
+        for pages in documents:
+            for i in range(len(pages)):
+                pages.thumbnail(i)
+    return run, len(documents) * ctx['pages']
+
+# 读取文字层（包含打开文件，文字层按文件缓存）
+def stage_text_layer(ctx):
+    paths = list(ctx['pdfs'].values())
+
+    def run():
+        for path in paths:
+            pages = pdf_pages.read_pdf(open(path, 'rb'), ctx['dpi'], cache=False)
+            for i in range(len(pages)):
+                ocr_engine.build_text_boxes(pages.text_results(i))
+            pages.close()
+    return run, len(paths) * ctx['pages']
+
+def stage_preprocess(ctx):
+    images = _all_images(ctx)
+
+    def run():
+        for image in images:
+            ocr_engine.preprocess_image(image)
+    return run, len(images)
+
+def stage_ocr(ctx):
+    images = _all_images(ctx)
+    _prepare_ocr(ctx)
+
+    def run():
+        ocr_engine.perform_ocr_batch(images, use_cache=False)
+    return run, len(images)
+
+def stage_merge(ctx):
+    results = [StubReader().readtext(image) for image in _all_images(ctx)]
+
+    def run():
+        for page_results in results:
+            ocr_engine.build_text_boxes(page_results)
+    return run, sum(len(r) for r in results)
+
+def stage_wrap_text(ctx):
+    texts = [(ENGLISH_LINE + " " + CJK_LINE) * (1 + i % 8) for i in range(500)]
+
+    def run():
+        for i, text in enumerate(texts):
+            wrap_text(text, 200 + (i % 5) * 100, 10 + i % 20)
+    return run, len(texts)
+
+def _overlays(image, count=5):
+    height, width = image.shape[:2]
+    return [(([[50, y], [width - 50, y], [width - 50, y + 30], [50, y + 30]]), f"{ENGLISH_LINE} {CJK_LINE}")
+            for y in range(100, min(height - 50, 100 + 150 * count), 150)]
+
+def stage_update_text(ctx):
+    images = _all_images(ctx)
+
+    def run():
+        for image in images:
+            edits = PageEdits()
+            for bbox, text in _overlays(image):
+                edits.add(image, make_overlay(bbox, text, 12, 2))
+    return run, len(images)
+
+def stage_export(ctx):
+    documents = _open_all(ctx)
+    edits = []
+    for pages in documents:
+        page_edits = {}
+        for i in range(len(pages)):
+            page_edits[i] = PageEdits()
+            for bbox, text in _overlays(pages[i], 2):
+                page_edits[i].add(pages[i], make_overlay(bbox, text, 12, 2))
+        edits.append(page_edits)
+    directory = tempfile.mkdtemp(prefix='bench_export_')
+
+    def run():
+        for n, (pages, page_edits) in enumerate(zip(documents, edits)):
+            export_pdf(pages, os.path.join(directory, f"{n}.pdf"), page_edits, mode='text')
+    return run, len(documents) * ctx['pages']
+
+STAGES = {
+    'read_pdf': stage_read_pdf,
+    'rasterize': stage_rasterize,
+    'thumbnails': stage_thumbnails,
+    'text_layer': stage_text_layer,
+    'preprocess': stage_preprocess,
+    'ocr': stage_ocr,
+    'merge': stage_merge,
+    'wrap_text': stage_wrap_text,
+    'update_text': stage_update_text,
+    'export': stage_export,
+}
+
+# 在独立进程中运行一个阶段，返回耗时和准备完成后的额外峰值内存
+def _run_stage(name, ctx, queue):
+    try:
+        run, items = STAGES[name](ctx)
+        run()  # 预热
+        # 重置峰值内存统计（Linux），只测量阶段本身
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        base = _rss_bytes('VmRSS:')
+        timings = []
+        for _ in range(ctx['repeat']):
+            start = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - start)
+        peak = _rss_bytes('VmHWM:')
+        median = float(np.median(timings))
+        queue.put({
+            'items': items,
+            'best_ms': min(timings) * 1000,
+            'median_ms': median * 1000,
+            'per_item_ms': median * 1000 / items if items else 0.0,
+            'peak_extra_mb': max(0, peak - base) / 1e6,
+        })
+    except Exception as e:
+        queue.put({'error': f"{type(e).__name__}: {e}"})
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'pymupdf': fitz.VersionBind,
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+    }
+
+# 与基准结果比较：中位耗时超过基准 (1 + tolerance) 倍的阶段视为退化
+def compare(result, baseline, tolerance):
+    regressions = []
+    print(f"{'阶段':<14}{'基准(ms)':>12}{'本次(ms)':>12}{'变化':>10}")
+    for name, stage in result['stages'].items():
+        base = baseline.get('stages', {}).get(name)
+        if 'error' in stage or not base or 'error' in base:
+            continue
+        ratio = stage['median_ms'] / base['median_ms'] if base['median_ms'] else 1.0
+        flag = ""
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = "  退化"
+        print(f"{name:<14}{base['median_ms']:>12.1f}{stage['median_ms']:>12.1f}{(ratio - 1) * 100:>9.1f}%{flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="PDF -> OCR -> 编辑 各阶段的耗时与峰值内存")
+    parser.add_argument('--pages', type=int, default=10, help="每种测试 PDF 的页数")
+    parser.add_argument('--dpi', type=int, default=pdf_pages.RENDER_DPI)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--ocr', choices=('stub', 'real'), default='stub', help="stub 使用固定的假识别器，real 使用 EasyOCR")
+    parser.add_argument('--stages', default=','.join(STAGES), help="要运行的阶段，以逗号分隔")
+    parser.add_argument('--output', help="把结果写入 JSON 文件")
+    parser.add_argument('--baseline', help="与之前保存的 JSON 结果比较")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="允许的变慢比例，超过时以状态码 1 退出")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bench_pipeline_')
+    ctx = {'pdfs': make_pdfs(directory, args.pages), 'pages': args.pages, 'dpi': args.dpi,
+           'repeat': args.repeat, 'ocr': args.ocr}
+    result = {'environment': environment(), 'config': {k: v for k, v in ctx.items() if k != 'pdfs'}, 'stages': {}}
+
+    mp = multiprocessing.get_context('spawn')
+    print(f"{'阶段':<14}{'项目数':>8}{'最快(ms)':>12}{'中位(ms)':>12}{'每项(ms)':>10}{'额外峰值(MB)':>14}")
+    for name in args.stages.split(','):
+        queue = mp.Queue()
+        proc = mp.Process(target=_run_stage, args=(name, ctx, queue))
+        proc.start()
+        stage = queue.get()
+        proc.join()
+        result['stages'][name] = stage
+        if 'error' in stage:
+            print(f"{name:<14}失败：{stage['error']}")
+        else:
+            print(f"{name:<14}{stage['items']:>8}{stage['best_ms']:>12.1f}{stage['median_ms']:>12.1f}"
+                  f"{stage['per_item_ms']:>10.2f}{stage['peak_extra_mb']:>14.1f}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(result, baseline, args.tolerance)
+        if regressions:
+            print(f"退化的阶段：{', '.join(regressions)}")
+            raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import argparse
+import os
+import sys
+import time
+import multiprocessing
+import cv2
+import numpy as np
+from PIL import Image, ImageDraw, ImageEnhance, ImageFilter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import image_pipeline
+from text_render import fit_text, get_face, draw_lines
+
+# 旧的预处理流程：PIL 滤波 -> 对比度 -> 灰度 -> np.array
+def legacy_preprocess(image):
+    im = image.filter(ImageFilter.MedianFilter())
+    enhancer = ImageEnhance.Contrast(im)
+    im = enhancer.enhance(2)
+    im = im.convert('L')
+    return np.array(im)
+
+# 新的预处理流程：数组 -> 灰度 -> medianBlur -> LUT
+def new_preprocess(array):
+    return image_pipeline.preprocess_gray(image_pipeline.to_gray(array))
+
+# 旧的文字更新流程：np.array -> BGR -> 绘制 -> RGB -> PIL
+def legacy_update(image):
+    cv_image = np.array(image)
+    cv_image = cv2.cvtColor(cv_image, cv2.COLOR_RGB2BGR)
+    cv2.rectangle(cv_image, (100, 100), (900, 160), (255, 255, 255), -1)
+    cv2.putText(cv_image, "benchmark", (100, 150), cv2.FONT_HERSHEY_SIMPLEX, 2, (0, 0, 0), 2)
+    return Image.fromarray(cv2.cvtColor(cv_image, cv2.COLOR_BGR2RGB))
+
+# 新的文字更新流程：复制一次数组后直接绘制，文字以 TrueType 字体排版（与 page_edits 相同）
+def new_update(array):
+    cv_image = array.copy()
+    cv2.rectangle(cv_image, (100, 100), (900, 160), (255, 255, 255), -1)
+    size, lines = fit_text("benchmark 基準測試", 800, 60, 48, stroke=1)
+    draw_lines(cv_image, get_face(size, 1), lines, 100, 100, (0, 0, 0))
+    return cv_image
+
+CASES = {
+    'preprocess/legacy': (legacy_preprocess, 'pil'),
+    'preprocess/new': (new_preprocess, 'array'),
+    'update/legacy': (legacy_update, 'pil'),
+    'update/new': (new_update, 'array'),
+}
+
+# 生成一张带文字的合成页面
+def make_page(width, height):
+    image = Image.new('RGB', (width, height), 'white')
+    draw = ImageDraw.Draw(image)
+    for y in range(50, height - 50, 40):
+        draw.text((50, y), "The quick brown fox jumps over the lazy dog 0123456789 " * 4, fill='black')
+    return image
+
+def _rss_bytes(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field):
+                return int(line.split()[1]) * 1024
+    return 0
+
+# 在独立进程中运行一个用例，返回耗时和相对于输入的额外峰值内存
+def _run_case(name, width, height, repeat, queue):
+    func, kind = CASES[name]
+    page = make_page(width, height)
+    arg = page if kind == 'pil' else np.ascontiguousarray(np.asarray(page))
+    func(arg)  # 预热
+    # 重置峰值内存统计（Linux），只测量用例本身
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+    base = _rss_bytes('VmRSS:')
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(arg)
+        timings.append(time.perf_counter() - start)
+    peak = _rss_bytes('VmHWM:')
+    queue.put({'best_ms': min(timings) * 1000, 'median_ms': float(np.median(timings)) * 1000, 'peak_extra_bytes': max(0, peak - base)})
+
+def main():
+    parser = argparse.ArgumentParser(description="比较旧的 PIL 预处理流程与新的 OpenCV/NumPy 流程")
+    parser.add_argument('--width', type=int, default=4960)
+    parser.add_argument('--height', type=int, default=7016)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    frame_bytes = args.width * args.height * 3
+    ctx = multiprocessing.get_context('spawn')
+    print(f"页面 {args.width}x{args.height}，RGB 帧大小 {frame_bytes / 1e6:.1f} MB")
+    print(f"{'用例':<20}{'最快(ms)':>10}{'中位(ms)':>10}{'额外峰值(MB)':>14}{'相当于帧数':>10}")
+    for name in CASES:
+        queue = ctx.Queue()
+        proc = ctx.Process(target=_run_case, args=(name, args.width, args.height, args.repeat, queue))
+        proc.start()
+        result = queue.get()
+        proc.join()
+        print(f"{name:<20}{result['best_ms']:>10.1f}{result['median_ms']:>10.1f}"
+              f"{result['peak_extra_bytes'] / 1e6:>14.1f}{result['peak_extra_bytes'] / frame_bytes:>10.2f}")
+
+if __name__ == "__main__":
+    main()
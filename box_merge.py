@@ -0,0 +1,180 @@
+import os
+import numpy as np
+from text_render import is_cjk
+
+# 合并层级：'line' 只把同一行的片段合并，'paragraph' 再把相邻的行合并成段落
+MERGE_LEVEL = os.environ.get('OCR_MERGE_LEVEL', 'line')
+# 两个框在垂直方向重叠至少为较矮框高度的该比例，才算同一行
+LINE_OVERLAP = 0.5
+# 同一行内两个片段的水平间距上限（以行高为单位）
+WORD_GAP = 1.0
+# 高度相差超过该倍数的框不合并（例如标题和正文）
+HEIGHT_RATIO = 2.0
+# 段落内相邻两行的垂直间距上限（以行高为单位）
+PARAGRAPH_GAP = 0.8
+
+# 当前的合并参数，用于生成缓存键
+def merge_params():
+    return {
+        'level': MERGE_LEVEL,
+        'line_overlap': LINE_OVERLAP,
+        'word_gap': WORD_GAP,
+        'height_ratio': HEIGHT_RATIO,
+        'paragraph_gap': PARAGRAPH_GAP,
+    }
+
+# 把 EasyOCR 的 bbox 列表转换为 (N, 4, 2) 数组
+def to_box_array(bboxes):
+    if not len(bboxes):
+        return np.zeros((0, 4, 2), dtype=np.float64)
+    return np.asarray(bboxes, dtype=np.float64).reshape(-1, 4, 2)
+
+# 轴对齐外接矩形 (x0, y0, x1, y1)
+def _extents(boxes):
+    return boxes[:, :, 0].min(axis=1), boxes[:, :, 1].min(axis=1), boxes[:, :, 0].max(axis=1), boxes[:, :, 1].max(axis=1)
+
+# 有序数组中每个 i 对应区间 [starts[i], ends[i]) 内的所有下标，展开成 (i, j) 对
+def _expand(starts, ends):
+    counts = np.maximum(ends - starts, 0)
+    first = np.repeat(np.arange(len(starts)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return first, np.repeat(starts, counts) + offsets
+
+# 找出可能相邻的框对（二维空间索引）：框 j 的顶边在框 i 顶边以下 reach[i] 之内，且水平间距不超过 x_reach[i]
+# 按 y 分成高度为最大 reach 的横带，每个带内按 x 排序：候选只在本带和下一带中，
+# 并用 searchsorted 只取 x 在范围内的框（同一行上很多框时不必两两比较）
+def _candidate_pairs(top, reach, left, right, x_reach):
+    n = len(top)
+    if n < 2:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp)
+    rank = np.empty(n, dtype=np.intp)
+    rank[np.argsort(top, kind='stable')] = np.arange(n)
+    band = np.floor((top - top.min()) / max(float(reach.max()), 1.0))
+    # 同一带内的键 = 带号 * span + x，span 足够大，各带的键（及查询范围）互不重叠
+    max_width = float((right - left).max())
+    pad = max_width + float(x_reach.max()) + 1
+    span = float(right.max() - left.min()) + 2 * pad + 1
+    x = left - left.min() + pad
+    keys = band * span + x
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    # j 的左边不小于 i 的左边减去最大宽度和 x_reach（否则 j 的右边离 i 太远），且不超过 i 的右边加 x_reach
+    low = x - max_width - x_reach
+    high = x + (right - left) + x_reach
+    firsts, seconds = [], []
+    for step in (0, 1):
+        base = (band + step) * span
+        starts = np.searchsorted(sorted_keys, base + low, side='left')
+        ends = np.searchsorted(sorted_keys, base + high, side='right')
+        first, second = _expand(starts, ends)
+        firsts.append(first)
+        seconds.append(order[second])
+    a, b = np.concatenate(firsts), np.concatenate(seconds)
+    # 每对只保留一次（b 在 a 之后），且 b 的顶边在 a 的 reach 之内
+    keep = (rank[b] > rank[a]) & (top[b] <= top[a] + reach[a])
+    return a[keep], b[keep]
+
+# 并查集：用最小标签传播加路径压缩求连通分量（向量化）
+def _union_find(n, a, b):
+    labels = np.arange(n)
+    if len(a) == 0:
+        return labels
+    while True:
+        low = np.minimum(labels[a], labels[b])
+        updated = labels.copy()
+        np.minimum.at(updated, labels[a], low)
+        np.minimum.at(updated, labels[b], low)
+        while True:
+            compressed = updated[updated]
+            if np.array_equal(compressed, updated):
+                break
+            updated = compressed
+        if np.array_equal(updated, labels):
+            return labels
+        labels = updated
+
+# 按标签分组，返回每组成员下标的列表（成员按原顺序排列）
+def _groups(labels):
+    order = np.argsort(labels, kind='stable')
+    splits = np.flatnonzero(np.diff(labels[order])) + 1
+    return np.split(order, splits)
+
+# 中文等宽字之间不加空格，其它情况用空格连接
+def _join(left, right):
+    if not left:
+        return right
+    if right and is_cjk(left[-1]) and is_cjk(right[0]):
+        return left + right
+    return left + " " + right
+
+# 同一行的框：垂直重叠足够、水平间距够小、高度相近
+def _line_labels(x0, y0, x1, y1):
+    heights = np.maximum(y1 - y0, 1)
+    a, b = _candidate_pairs(y0, heights, x0, x1, WORD_GAP * heights)
+    if len(a):
+        overlap = np.minimum(y1[a], y1[b]) - np.maximum(y0[a], y0[b])
+        min_h = np.minimum(heights[a], heights[b])
+        gap = np.maximum(x0[b] - x1[a], x0[a] - x1[b])
+        keep = ((overlap >= LINE_OVERLAP * min_h)
+                & (gap <= WORD_GAP * min_h)
+                & (np.maximum(heights[a], heights[b]) <= HEIGHT_RATIO * min_h))
+        a, b = a[keep], b[keep]
+    return _union_find(len(x0), a, b)
+
+# 相邻的行合并成段落：行距够小、水平方向有重叠、行高相近
+def _paragraph_labels(x0, y0, x1, y1):
+    heights = np.maximum(y1 - y0, 1)
+    a, b = _candidate_pairs(y0, heights * (1 + PARAGRAPH_GAP), x0, x1, np.zeros_like(x0))
+    if len(a):
+        vgap = np.maximum(y0[b] - y1[a], y0[a] - y1[b])
+        min_h = np.minimum(heights[a], heights[b])
+        hoverlap = np.minimum(x1[a], x1[b]) - np.maximum(x0[a], x0[b])
+        keep = ((vgap <= PARAGRAPH_GAP * min_h)
+                & (hoverlap > 0)
+                & (np.maximum(heights[a], heights[b]) <= HEIGHT_RATIO * min_h))
+        a, b = a[keep], b[keep]
+    return _union_find(len(x0), a, b)
+
+# 合并文字区域，返回 [(bbox, text, line_height)]，顺序与每组第一个框在原结果中的顺序一致
+# 只有一个框的组保留原始的四边形 bbox
+def merge_text_boxes(results, level=None):
+    level = level or MERGE_LEVEL
+    if not results:
+        return []
+    bboxes = [bbox for bbox, _, _ in results]
+    texts = [text for _, text, _ in results]
+    x0, y0, x1, y1 = _extents(to_box_array(bboxes))
+
+    lines = []
+    for members in _groups(_line_labels(x0, y0, x1, y1)):
+        members = members[np.argsort(x0[members], kind='stable')]
+        text = ""
+        for i in members:
+            text = _join(text, texts[i])
+        lines.append((members, text))
+
+    n = len(lines)
+    lx0 = np.array([x0[m].min() for m, _ in lines])
+    ly0 = np.array([y0[m].min() for m, _ in lines])
+    lx1 = np.array([x1[m].max() for m, _ in lines])
+    ly1 = np.array([y1[m].max() for m, _ in lines])
+    if level == 'paragraph':
+        paragraphs = _groups(_paragraph_labels(lx0, ly0, lx1, ly1))
+    else:
+        paragraphs = [np.array([i]) for i in range(n)]
+
+    merged = []
+    for group in paragraphs:
+        group = group[np.argsort(ly0[group], kind='stable')]
+        members = np.concatenate([lines[i][0] for i in group])
+        if len(members) == 1:
+            bbox = bboxes[members[0]]
+        else:
+            left, top, right, bottom = lx0[group].min(), ly0[group].min(), lx1[group].max(), ly1[group].max()
+            left, top, right, bottom = float(left), float(top), float(right), float(bottom)
+            bbox = [(left, top), (right, top), (right, bottom), (left, bottom)]
+        text = "\n".join(lines[i][1] for i in group)
+        line_height = float(np.median(ly1[group] - ly0[group]))
+        merged.append((members.min(), bbox, text, line_height))
+    merged.sort(key=lambda item: item[0])
+    return [(bbox, text, line_height) for _, bbox, text, line_height in merged]
@@ -0,0 +1,202 @@
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# 数据库文件、等待锁的超时时间（秒）和连接池中保留的空闲连接数
+DB_PATH = os.environ.get('USERS_DB_PATH', 'users.db')
+BUSY_TIMEOUT = float(os.environ.get('USERS_DB_BUSY_TIMEOUT', 10))
+POOL_SIZE = int(os.environ.get('USERS_DB_POOL_SIZE', 8))
+# 管理员用户列表每页显示的用户数
+ADMIN_PAGE_SIZE = int(os.environ.get('ADMIN_PAGE_SIZE', 50))
+
+# 与 users 表列顺序一致的字段列表，查询时显式列出，不依赖表中列的物理顺序
+USER_COLUMNS = "username, password, membership, role, credits, premium_expiry, free_uses, last_reset"
+
+_pool = queue.LifoQueue()
+_init_lock = threading.Lock()
+_initialized = False
+
+# 建立新连接：自动提交模式，事务由 transaction() 显式开启
+def _connect():
+    conn = sqlite3.connect(DB_PATH, timeout=BUSY_TIMEOUT, check_same_thread=False,
+                           isolation_level=None, cached_statements=128)
+    conn.execute(f"PRAGMA busy_timeout = {int(BUSY_TIMEOUT * 1000)}")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    return conn
+
+# 从连接池借用一个连接，用完后归还
+@contextmanager
+def connection():
+    try:
+        conn = _pool.get_nowait()
+    except queue.Empty:
+        conn = _connect()
+    try:
+        yield conn
+    finally:
+        if conn.in_transaction:
+            conn.rollback()
+        if _pool.qsize() < POOL_SIZE:
+            _pool.put(conn)
+        else:
+            conn.close()
+
+# 在一个写事务中执行多条语句（BEGIN IMMEDIATE 提前取得写锁，避免升级锁时死锁）
+@contextmanager
+def transaction():
+    with connection() as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+# 查询单行
+def query_one(sql, params=()):
+    with connection() as conn:
+        return conn.execute(sql, params).fetchone()
+
+# 查询多行
+def query_all(sql, params=()):
+    with connection() as conn:
+        return conn.execute(sql, params).fetchall()
+
+# 执行单条写语句，返回受影响的行数
+def execute(sql, params=()):
+    with connection() as conn:
+        return conn.execute(sql, params).rowcount
+
+# 检查并创建表
+def create_table_if_not_exists(cursor, table_name):
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {table_name} (
+            username TEXT PRIMARY KEY,
+            password TEXT,
+            membership TEXT,
+            role TEXT DEFAULT 'user',
+            credits INTEGER DEFAULT 0,
+            premium_expiry TEXT,
+            free_uses INTEGER DEFAULT 5,
+            last_reset TEXT
+        )
+    """)
+
+# 检查并添加缺失的数据库列
+def add_column_if_not_exists(cursor, table_name, column_name, column_type):
+    cursor.execute(f"PRAGMA table_info({table_name})")
+    columns = [info[1] for info in cursor.fetchall()]
+    if column_name not in columns:
+        cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}")
+
+# 版本 1：users 表及旧版数据库中缺失的列
+def _migrate_users_table(conn):
+    c = conn.cursor()
+    create_table_if_not_exists(c, 'users')
+    add_column_if_not_exists(c, 'users', 'membership', 'TEXT')
+    add_column_if_not_exists(c, 'users', 'role', 'TEXT DEFAULT "user"')
+    add_column_if_not_exists(c, 'users', 'credits', 'INTEGER DEFAULT 0')
+    add_column_if_not_exists(c, 'users', 'premium_expiry', 'TEXT')
+    add_column_if_not_exists(c, 'users', 'free_uses', 'INTEGER DEFAULT 5')
+    add_column_if_not_exists(c, 'users', 'last_reset', 'TEXT')
+
+# 版本 2：管理员列表按会员类型、角色筛选和按到期时间统计所用的索引
+def _add_user_indexes(conn):
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_membership ON users (membership, username)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_role ON users (role, username)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_premium_expiry ON users (premium_expiry)")
+
+# 数据库迁移：按顺序执行，已执行的版本记录在 PRAGMA user_version
+MIGRATIONS = [
+    _migrate_users_table,
+    _add_user_indexes,
+]
+
+# 执行尚未执行的迁移
+def migrate():
+    with connection() as conn:
+        conn.execute("PRAGMA journal_mode = WAL")
+    with transaction() as conn:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            logger.info("执行数据库迁移 %d: %s", number, migration.__name__)
+            migration(conn)
+            conn.execute(f"PRAGMA user_version = {number}")
+
+# 每个进程只初始化一次数据库；首次初始化时返回 True
+def init_db():
+    global _initialized
+    if _initialized:
+        return False
+    with _init_lock:
+        if _initialized:
+            return False
+        migrate()
+        _initialized = True
+        return True
+
+# 验证登录
+@metrics.timed('db.validate_login')
+def validate_login(username, password):
+    return query_one(f"SELECT {USER_COLUMNS} FROM users WHERE username = ? AND password = ?", (username, password))
+
+# 验证注册
+@metrics.timed('db.validate_signup')
+def validate_signup(username):
+    return query_one(f"SELECT {USER_COLUMNS} FROM users WHERE username = ?", (username,))
+
+# 创建用户
+@metrics.timed('db.create_user')
+def create_user(username, password, membership, role='user'):
+    execute("INSERT INTO users (username, password, membership, role, credits, free_uses, last_reset) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (username, password, membership, role, 0, 5, datetime.now().strftime('%Y-%m-%d')))
+
+# 分页查询用户（按用户名的 keyset 分页）：返回 after 之后的最多 limit 个用户
+# search 为用户名前缀，以范围条件查询以便使用主键索引
+@metrics.timed('db.list_users')
+def list_users(after=None, search="", membership=None, role=None, limit=ADMIN_PAGE_SIZE):
+    conditions, params = [], []
+    if after is not None:
+        conditions.append("username > ?")
+        params.append(after)
+    if search:
+        conditions.append("username >= ? AND username < ?")
+        params += [search, search + '\U0010ffff']
+    if membership:
+        conditions.append("membership = ?")
+        params.append(membership)
+    if role:
+        conditions.append("role = ?")
+        params.append(role)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return query_all(f"SELECT {USER_COLUMNS} FROM users {where} ORDER BY username LIMIT ?", params + [limit])
+
+# 用户统计：总数、付费会员、免费会员、管理员及 expiring_before 之前到期的付费会员，一次查询完成
+@metrics.timed('db.count_users')
+def count_users(today, expiring_before):
+    row = query_one("""
+        SELECT COUNT(*),
+               COALESCE(SUM(membership = 'premium'), 0),
+               COALESCE(SUM(membership = 'free'), 0),
+               COALESCE(SUM(role = 'admin'), 0),
+               COALESCE(SUM(membership = 'premium' AND premium_expiry >= ? AND premium_expiry < ?), 0)
+        FROM users
+    """, (today, expiring_before))
+    return dict(zip(('total', 'premium', 'free', 'admin', 'expiring'), row))
+
+# 批量删除用户（管理员不会被删除），在一个事务中完成，返回删除的数量
+@metrics.timed('db.delete_users')
+def delete_users(usernames):
+    with transaction() as conn:
+        before = conn.total_changes
+        conn.executemany("DELETE FROM users WHERE username = ? AND COALESCE(role, 'user') != 'admin'",
+                         [(username,) for username in usernames])
+        return conn.total_changes - before
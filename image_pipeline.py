@@ -0,0 +1,48 @@
+import io
+import cv2
+import numpy as np
+
+# 页面在整个流程中都以连续的 uint8 数组保存：彩色为 (H, W, 3) 的 RGB，灰度为 (H, W)
+# st.image 可以直接显示这种数组，不需要再转换成 PIL 图片
+
+# 把 PIL 图片或数组转换为连续的 uint8 数组；已经符合要求的数组不会复制
+def as_array(image):
+    if not isinstance(image, np.ndarray):
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        image = np.asarray(image)
+    if image.dtype != np.uint8:
+        image = (image >> 8).astype(np.uint8) if image.dtype == np.uint16 else image.astype(np.uint8)
+    if image.ndim == 3 and image.shape[2] == 4:
+        image = cv2.cvtColor(image, cv2.COLOR_RGBA2RGB)
+    return np.ascontiguousarray(image)
+
+# 把 PDF 中提取出的图片字节直接解码为数组；OpenCV 不支持的格式交给 PIL
+def decode_image(data):
+    array = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_ANYCOLOR)
+    if array is None:
+        from PIL import Image
+        return as_array(Image.open(io.BytesIO(data)))
+    if array.ndim == 3:
+        cv2.cvtColor(array, cv2.COLOR_BGR2RGB, dst=array)
+    return array
+
+# 转为灰度；本身是灰度时直接返回原数组
+def to_gray(array):
+    if array.ndim == 2:
+        return array
+    return cv2.cvtColor(array, cv2.COLOR_RGB2GRAY)
+
+# 对比度查找表，与 PIL 的 ImageEnhance.Contrast 相同：以灰度均值为中心拉伸
+def contrast_lut(gray, factor):
+    mean = int(cv2.mean(gray)[0] + 0.5)
+    return np.clip(np.rint(mean + factor * (np.arange(256) - mean)), 0, 255).astype(np.uint8)
+
+# OCR 预处理：缩放、中值滤波、查表增强对比度（原地进行），不修改传入的数组
+def preprocess_gray(gray, scale=1.0, median=3, contrast=2):
+    if scale < 1.0:
+        height, width = gray.shape[:2]
+        gray = cv2.resize(gray, (max(1, round(width * scale)), max(1, round(height * scale))), interpolation=cv2.INTER_AREA)
+    blurred = cv2.medianBlur(gray, median)
+    cv2.LUT(blurred, contrast_lut(blurred, contrast), dst=blurred)
+    return blurred
@@ -0,0 +1,243 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+# 指标导出文件（Prometheus 文本格式，可由 node_exporter 的 textfile collector 读取）及写入间隔（秒）
+METRICS_FILE = os.environ.get('METRICS_FILE') or None
+METRICS_INTERVAL = float(os.environ.get('METRICS_INTERVAL', 15))
+METRIC_PREFIX = 'pdf_ocr'
+# 按 session 输出的页面存储统计
+SESSION_GAUGES = ('resident_bytes', 'resident_pages', 'spilled_bytes', 'spilled_pages')
+# 耗时直方图的桶上限（秒）
+SPAN_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+# cProfile 报告中列出的函数数量
+PROFILE_TOP = 40
+
+# 本进程的耗时统计（名称 -> 次数、总和、最大值、各桶次数）和计数器
+_lock = threading.Lock()
+_spans = {}
+_counters = {}
+_exporter = None
+_profile_requested = False
+_last_profile = None
+
+def _new_span():
+    return {'count': 0, 'sum': 0.0, 'max': 0.0, 'buckets': [0] * len(SPAN_BUCKETS)}
+
+# 记录一次耗时（秒）
+def observe(name, seconds):
+    with _lock:
+        span = _spans.get(name)
+        if span is None:
+            span = _spans[name] = _new_span()
+        span['count'] += 1
+        span['sum'] += seconds
+        span['max'] = max(span['max'], seconds)
+        for i, bound in enumerate(SPAN_BUCKETS):
+            if seconds <= bound:
+                span['buckets'][i] += 1
+                break
+
+# 统计一段代码的耗时
+@contextmanager
+def span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+# 统计函数耗时的装饰器
+def timed(name):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# 计数器加一（或加 amount）
+def increment(name, amount=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+def snapshot():
+    with _lock:
+        return {
+            'spans': {name: dict(span, buckets=list(span['buckets'])) for name, span in _spans.items()},
+            'counters': dict(_counters),
+        }
+
+# 取出并清空本进程的统计；OCR 工作进程把它随识别结果一起交给主进程合并
+def drain():
+    with _lock:
+        data = {'spans': dict(_spans), 'counters': dict(_counters)}
+        _spans.clear()
+        _counters.clear()
+    return data
+
+# 合并其他进程的统计
+def merge(data):
+    with _lock:
+        for name, other in data['spans'].items():
+            span = _spans.get(name)
+            if span is None:
+                span = _spans[name] = _new_span()
+            span['count'] += other['count']
+            span['sum'] += other['sum']
+            span['max'] = max(span['max'], other['max'])
+            span['buckets'] = [a + b for a, b in zip(span['buckets'], other['buckets'])]
+        for name, value in data['counters'].items():
+            _counters[name] = _counters.get(name, 0) + value
+
+def reset():
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+
+# 各模块已有的统计数据（缓存命中、任务队列、内存占用、模型加载），在读取时才收集
+def component_stats():
+    import ocr_cache
+    import ocr_engine
+    import page_store
+    import pdf_pages
+    from ocr_jobs import get_job_manager
+
+    return {
+        'image_cache': pdf_pages.image_cache.stats(),
+        'thumbnail_cache': pdf_pages.thumbnail_cache.stats(),
+        'ocr_cache': ocr_cache.get_cache().stats(),
+        'ocr_jobs': get_job_manager().stats(),
+        'page_store': page_store.global_stats(),
+        'ocr_model': ocr_engine.get_model_stats(),
+    }
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# 以 Prometheus 文本格式输出所有指标：耗时为直方图，计数器为 counter，各模块的统计数字为 gauge
+def render_prometheus(components=None):
+    data = snapshot()
+    if components is None:
+        components = component_stats()
+    name = f"{METRIC_PREFIX}_span_seconds"
+    lines = [f"# HELP {name} Time spent in instrumented code paths.", f"# TYPE {name} histogram"]
+    for span_name, span in sorted(data['spans'].items()):
+        label = f'span="{_label(span_name)}"'
+        cumulative = 0
+        for bound, count in zip(SPAN_BUCKETS, span['buckets']):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{label},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{label},le="+Inf"}} {span["count"]}')
+        lines.append(f"{name}_sum{{{label}}} {span['sum']:.6f}")
+        lines.append(f"{name}_count{{{label}}} {span['count']}")
+    name = f"{METRIC_PREFIX}_events_total"
+    lines += [f"# HELP {name} Event counters (reruns, cache hits and misses).", f"# TYPE {name} counter"]
+    for event, value in sorted(data['counters'].items()):
+        lines.append(f'{name}{{event="{_label(event)}"}} {value}')
+    for component, values in components.items():
+        for key, value in values.items():
+            # 只输出数字（列表、字典等明细不输出）
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            name = f"{METRIC_PREFIX}_{component}_{key}"
+            lines += [f"# TYPE {name} gauge", f"{name} {value}"]
+    # 各 session 的页面存储（以用户名和存储编号为标签）
+    sessions = components.get('page_store', {}).get('sessions', [])
+    for key in SESSION_GAUGES if sessions else ():
+        name = f"{METRIC_PREFIX}_page_store_session_{key}"
+        lines.append(f"# TYPE {name} gauge")
+        for session in sessions:
+            lines.append(f'{name}{{session="{_label(session["name"])}",store="{session["id"]}"}} {session[key]}')
+    return '\n'.join(lines) + '\n'
+
+# 写入指标文件（先写临时文件再改名，读取方不会看到写了一半的文件）
+def write_metrics(path=METRICS_FILE):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(prefix='.metrics_', dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(render_prometheus())
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+def _export_loop(path, interval):
+    while True:
+        time.sleep(interval)
+        try:
+            write_metrics(path)
+        except Exception:
+            logger.exception("写入指标文件 %s 失败", path)
+
+# 设置了 METRICS_FILE 时，在后台线程中定期写入指标文件（每个进程只启动一次）
+def start_exporter(path=METRICS_FILE, interval=METRICS_INTERVAL):
+    global _exporter
+    if not path or _exporter is not None:
+        return
+    with _lock:
+        if _exporter is not None:
+            return
+        _exporter = threading.Thread(target=_export_loop, args=(path, interval), name='metrics_exporter', daemon=True)
+    _exporter.start()
+
+# 要求以 cProfile 分析下一次执行（任何用户的下一次 rerun）
+def request_profile():
+    global _profile_requested
+    with _lock:
+        _profile_requested = True
+
+def profile_requested():
+    return _profile_requested
+
+# 有分析要求时以 cProfile 分析这段代码（只分析一次），结果可由 last_profile() 取得
+@contextmanager
+def maybe_profile(label=""):
+    global _profile_requested, _last_profile
+    with _lock:
+        requested, _profile_requested = _profile_requested, False
+    if not requested:
+        yield
+        return
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        elapsed = time.perf_counter() - start
+        text = io.StringIO()
+        pstats.Stats(profiler, stream=text).sort_stats('cumulative').print_stats(PROFILE_TOP)
+        fd, path = tempfile.mkstemp(suffix='.prof')
+        os.close(fd)
+        try:
+            profiler.dump_stats(path)
+            with open(path, 'rb') as f:
+                data = f.read()
+        finally:
+            os.remove(path)
+        _last_profile = {
+            'label': label,
+            'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'seconds': elapsed,
+            'text': text.getvalue(),
+            'data': data,
+        }
+        logger.info("已分析一次执行（%s），耗时 %.2fs", label, elapsed)
+
+# 最近一次分析的结果：label、time、seconds、text（按累计耗时排序的报告）、data（.prof 文件内容）
+def last_profile():
+    return _last_profile
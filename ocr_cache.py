@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+import numpy as np
+
+# OCR 结果缓存文件（与 users.db 放在同一目录）及其大小上限（MB）
+OCR_CACHE_PATH = os.environ.get('OCR_CACHE_PATH', 'ocr_cache.db')
+OCR_CACHE_MB = int(os.environ.get('OCR_CACHE_MB', 512))
+
+# 计算图片像素的哈希（直接读取数组的内存，不额外复制）
+def image_digest(image):
+    array = np.ascontiguousarray(np.asarray(image))
+    h = hashlib.sha256()
+    h.update(f"{array.dtype}:{array.shape}:".encode())
+    h.update(array)
+    return h.hexdigest()
+
+# 生成缓存键：像素哈希 + 模型语言 + 预处理/解码参数
+def make_key(digest, langs, params):
+    payload = json.dumps({'langs': sorted(langs), 'params': params}, sort_keys=True)
+    return hashlib.sha256(f"{digest}:{payload}".encode()).hexdigest()
+
+# 将 numpy 数值转换为可以 JSON 序列化的类型
+def _to_builtin(value):
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    raise TypeError(f"无法序列化 {type(value)}")
+
+def _encode(results):
+    return zlib.compress(json.dumps(results, default=_to_builtin, ensure_ascii=False).encode('utf-8'))
+
+def _decode(blob):
+    return [(bbox, text, font_size) for bbox, text, font_size in json.loads(zlib.decompress(blob).decode('utf-8'))]
+
+# 基于 SQLite 的持久化 OCR 结果缓存，按最近使用时间淘汰
+class OcrCache:
+    def __init__(self, path=OCR_CACHE_PATH, max_bytes=OCR_CACHE_MB * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS ocr_results (
+                key TEXT PRIMARY KEY,
+                data BLOB,
+                size INTEGER,
+                last_used REAL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_ocr_results_last_used ON ocr_results (last_used)")
+        self._conn.commit()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM ocr_results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE ocr_results SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+        return _decode(row[0])
+
+    def put(self, key, results):
+        blob = _encode(results)
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO ocr_results (key, data, size, last_used) VALUES (?, ?, ?, ?)",
+                               (key, blob, len(blob), time.time()))
+            self._evict()
+            self._conn.commit()
+
+    # 超出大小上限时删除最久未使用的结果
+    def _evict(self):
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM ocr_results").fetchone()[0]
+        while total > self.max_bytes:
+            rows = self._conn.execute("SELECT key, size FROM ocr_results ORDER BY last_used LIMIT 100").fetchall()
+            if len(rows) <= 1:
+                break
+            for key, size in rows[:-1]:
+                self._conn.execute("DELETE FROM ocr_results WHERE key = ?", (key,))
+                self.evictions += 1
+                total -= size
+                if total <= self.max_bytes:
+                    break
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM ocr_results")
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            entries, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM ocr_results").fetchone()
+        return {
+            'entries': entries,
+            'bytes': total,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+_cache = None
+_cache_lock = threading.Lock()
+
+# 获取进程共享的缓存（首次使用时才创建数据库文件）
+def get_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = OcrCache()
+    return _cache
@@ -0,0 +1,260 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import box_merge
+import image_pipeline
+import metrics
+import ocr_cache
+import ocr_tiling
+
+logger = logging.getLogger(__name__)
+
+# 默认的 OCR 语言与解码参数
+DEFAULT_LANGS = ('ch_sim', 'en')
+DEFAULT_DECODER = 'greedy'
+DEFAULT_BEAM_WIDTH = 5
+
+# 预处理参数（会写入 OCR 缓存键）
+PIPELINE_VERSION = 4
+MEDIAN_FILTER_SIZE = 3
+CONTRAST_FACTOR = 2
+
+# 进程级别的模型注册表：同一进程内的所有 session 和 rerun 共用
+_models = {}
+_models_lock = threading.Lock()
+
+# 启动耗时与首次 OCR 耗时分开统计
+_process_start = time.perf_counter()
+_stats = {
+    'startup_seconds': None,
+    'first_ocr_seconds': None,
+    'model_loads': {},
+}
+# 工作进程中尚未报告给主进程的模型加载耗时；主进程中记录工作进程已加载的模型
+_unreported_loads = {}
+_worker_models = set()
+
+# 生成模型的缓存键（语言集合 + 解码选项）
+def model_key(langs=DEFAULT_LANGS, decoder=DEFAULT_DECODER, beam_width=DEFAULT_BEAM_WIDTH, gpu=True):
+    return (tuple(sorted(langs)), decoder, int(beam_width), bool(gpu))
+
+# 模型缓存键的文字形式，例如 ch_sim+en/greedy/5/gpu（统计数据以它为键，可直接转为 JSON）
+def model_label(key):
+    langs, decoder, beam_width, gpu = key
+    return f"{'+'.join(langs)}/{decoder}/{beam_width}/{'gpu' if gpu else 'cpu'}"
+
+# 加载 EasyOCR 模型
+def _load_model(key):
+    import easyocr
+
+    langs, decoder, beam_width, gpu = key
+    start = time.perf_counter()
+    reader = easyocr.Reader(list(langs), gpu=gpu)
+    elapsed = time.perf_counter() - start
+    _stats['model_loads'][model_label(key)] = elapsed
+    _unreported_loads[model_label(key)] = elapsed
+    logger.info("EasyOCR 模型 %s 加载耗时 %.2fs", model_label(key), elapsed)
+    return {
+        'reader': reader,
+        'readtext_kwargs': {'decoder': decoder, 'beamWidth': beam_width},
+    }
+
+# 获取模型（首次调用时才加载）
+def get_model(langs=DEFAULT_LANGS, decoder=DEFAULT_DECODER, beam_width=DEFAULT_BEAM_WIDTH, gpu=True):
+    key = model_key(langs, decoder, beam_width, gpu)
+    model = _models.get(key)
+    if model is None:
+        with _models_lock:
+            model = _models.get(key)
+            if model is None:
+                model = _load_model(key)
+                _models[key] = model
+    return model
+
+# 获取 EasyOCR 读者
+def get_reader(langs=DEFAULT_LANGS, decoder=DEFAULT_DECODER, beam_width=DEFAULT_BEAM_WIDTH, gpu=True):
+    return get_model(langs, decoder, beam_width, gpu)['reader']
+
+# 预热模型：加载后用一张空白小图跑一次推理，触发惰性初始化（在 OCR 工作进程中执行，见 OcrJobManager.warm_up）
+def warm_up(langs=DEFAULT_LANGS, decoder=DEFAULT_DECODER, beam_width=DEFAULT_BEAM_WIDTH, gpu=True):
+    model = get_model(langs, decoder, beam_width, gpu)
+    blank = np.full((32, 32), 255, dtype=np.uint8)
+    model['reader'].readtext(blank, detail=1, **model['readtext_kwargs'])
+
+# 记录应用启动耗时（只记录一次）
+def mark_startup_complete():
+    if _stats['startup_seconds'] is None:
+        _stats['startup_seconds'] = time.perf_counter() - _process_start
+        logger.info("应用启动耗时 %.2fs", _stats['startup_seconds'])
+
+# 获取模型相关的统计数据
+def get_model_stats():
+    return {
+        'startup_seconds': _stats['startup_seconds'],
+        'first_ocr_seconds': _stats['first_ocr_seconds'],
+        'model_loads': dict(_stats['model_loads']),
+        'loaded_models': sorted({model_label(key) for key in list(_models)} | _worker_models),
+    }
+
+# 取出并清空本进程新的模型加载记录；OCR 工作进程把它随识别结果一起交给主进程（与 metrics.drain 相同）
+def drain_model_stats():
+    with _models_lock:
+        loads = dict(_unreported_loads)
+        _unreported_loads.clear()
+    return {'model_loads': loads, 'loaded_models': [model_label(key) for key in list(_models)]}
+
+# 合并工作进程的模型加载记录
+def merge_model_stats(data):
+    _stats['model_loads'].update(data['model_loads'])
+    _worker_models.update(data['loaded_models'])
+
+# 工作进程重启后清空它们的模型记录
+def forget_worker_models():
+    _worker_models.clear()
+
+# 当前 OCR 参数，用于生成缓存键
+def ocr_params(decoder=DEFAULT_DECODER, beam_width=DEFAULT_BEAM_WIDTH):
+    return {
+        'pipeline': PIPELINE_VERSION,
+        'glyph_height': ocr_tiling.TARGET_GLYPH_HEIGHT,
+        'max_tile_pixels': ocr_tiling.max_tile_pixels(),
+        'median': MEDIAN_FILTER_SIZE,
+        'contrast': CONTRAST_FACTOR,
+        'decoder': decoder,
+        'beam_width': beam_width,
+        'merge': box_merge.merge_params(),
+    }
+
+# 生成某张图片的 OCR 缓存键
+def ocr_cache_key(image, langs=DEFAULT_LANGS, decoder=DEFAULT_DECODER, beam_width=DEFAULT_BEAM_WIDTH):
+    return ocr_cache.make_key(ocr_cache.image_digest(image), langs, ocr_params(decoder, beam_width))
+
+# 只查询缓存，不执行 OCR（未命中时返回 None）
+def lookup_cached_ocr(image, langs=DEFAULT_LANGS, decoder=DEFAULT_DECODER, beam_width=DEFAULT_BEAM_WIDTH):
+    return ocr_cache.get_cache().get(ocr_cache_key(image, langs, decoder, beam_width))
+
+# 图片预处理：先转灰度并按字高缩小，再去噪、增强对比度
+# 返回 (灰度图, 缩放比例)
+def preprocess_image(image):
+    gray = image_pipeline.to_gray(image_pipeline.as_array(image))
+    scale = ocr_tiling.working_scale(gray)
+    return image_pipeline.preprocess_gray(gray, scale, MEDIAN_FILTER_SIZE, CONTRAST_FACTOR), scale
+
+# 在工作分辨率上识别文字；超过像素上限时切成有重叠的分块并行识别
+def readtext_tiled(model, gray):
+    height, width = gray.shape[:2]
+    overlap = max(64, 3 * ocr_tiling.TARGET_GLYPH_HEIGHT)
+    tiles = ocr_tiling.plan_tiles(height, width, ocr_tiling.max_tile_pixels(), overlap)
+
+    def run(tile):
+        x, y, w, h = tile
+        # canvas_size 设为分块大小，避免 EasyOCR 再次缩小检测输入
+        results = model['reader'].readtext(gray[y:y + h, x:x + w], detail=1, canvas_size=max(w, h), **model['readtext_kwargs'])
+        return ocr_tiling.map_results(results, x, y)
+
+    if len(tiles) == 1:
+        return run(tiles[0])
+    with ThreadPoolExecutor(max_workers=max(1, ocr_tiling.TILE_THREADS)) as executor:
+        parts = list(executor.map(run, tiles))
+    return ocr_tiling.dedupe_results(parts, tiles)
+
+# 把 EasyOCR 的识别结果整理成 (bbox, text, font_size) 列表
+def build_text_boxes(results):
+    # 合并接近的文字区域
+    return [(bbox, text, estimate_font_size(bbox, line_height)) for bbox, text, line_height in box_merge.merge_text_boxes(results)]
+
+# 记录首次 OCR 耗时（只记录一次）；网页进程不执行 OCR，由任务管理器在首个任务批次完成时记录
+def record_first_ocr(seconds):
+    if _stats['first_ocr_seconds'] is None:
+        _stats['first_ocr_seconds'] = seconds
+        logger.info("首次 OCR 耗时 %.2fs（含模型加载）", _stats['first_ocr_seconds'])
+
+# 执行OCR识别（先查询持久化缓存）
+def perform_ocr(image, langs=DEFAULT_LANGS, decoder=DEFAULT_DECODER, beam_width=DEFAULT_BEAM_WIDTH, use_cache=True):
+    cache_key = None
+    if use_cache:
+        with metrics.span('ocr.cache_lookup'):
+            cache_key = ocr_cache_key(image, langs, decoder, beam_width)
+            cached = ocr_cache.get_cache().get(cache_key)
+        if cached is not None:
+            metrics.increment('ocr_cache_hits')
+            return cached
+        metrics.increment('ocr_cache_misses')
+
+    # EasyOCR 的检测与识别在同一次 readtext 调用中完成，合并计时
+    start = time.perf_counter()
+    with metrics.span('ocr.model'):
+        model = get_model(langs, decoder, beam_width)
+    with metrics.span('ocr.preprocess'):
+        gray, scale = preprocess_image(image)
+    with metrics.span('ocr.readtext'):
+        results = ocr_tiling.map_results(readtext_tiled(model, gray), scale=scale)
+    del gray
+    with metrics.span('ocr.merge'):
+        text_boxes = build_text_boxes(results)
+    record_first_ocr(time.perf_counter() - start)
+
+    if cache_key is not None:
+        with metrics.span('ocr.cache_write'):
+            ocr_cache.get_cache().put(cache_key, text_boxes)
+    return text_boxes
+
+# 批量执行OCR：尺寸相同的页面一起送入 readtext_batched，减少逐页调用的开销
+def perform_ocr_batch(images, langs=DEFAULT_LANGS, decoder=DEFAULT_DECODER, beam_width=DEFAULT_BEAM_WIDTH, use_cache=True):
+    outputs = [None] * len(images)
+    cache_keys = [None] * len(images)
+    if use_cache:
+        with metrics.span('ocr.cache_lookup'):
+            for i, image in enumerate(images):
+                cache_keys[i] = ocr_cache_key(image, langs, decoder, beam_width)
+                outputs[i] = ocr_cache.get_cache().get(cache_keys[i])
+    todo = [i for i, output in enumerate(outputs) if output is None]
+    if use_cache:
+        metrics.increment('ocr_cache_hits', len(images) - len(todo))
+        metrics.increment('ocr_cache_misses', len(todo))
+    if not todo:
+        return outputs
+
+    start = time.perf_counter()
+    with metrics.span('ocr.model'):
+        model = get_model(langs, decoder, beam_width)
+    prepared = {}
+    for i in todo:
+        with metrics.span('ocr.preprocess'):
+            prepared[i] = preprocess_image(images[i])
+    groups = {}
+    for i in todo:
+        groups.setdefault(prepared[i][0].shape, []).append(i)
+
+    max_pixels = ocr_tiling.max_tile_pixels()
+    for shape, indices in groups.items():
+        # 一批的总像素不超过内存上限；单页超过上限时分块识别
+        per_batch = max_pixels // (shape[0] * shape[1])
+        if per_batch < 2:
+            batches = [[i] for i in indices]
+        else:
+            batches = [indices[k:k + per_batch] for k in range(0, len(indices), per_batch)]
+        for batch in batches:
+            with metrics.span('ocr.readtext'):
+                if len(batch) == 1:
+                    batch_results = [readtext_tiled(model, prepared[batch[0]][0])]
+                else:
+                    batch_results = model['reader'].readtext_batched([prepared[i][0] for i in batch], detail=1, canvas_size=max(shape[:2]), **model['readtext_kwargs'])
+            for i, results in zip(batch, batch_results):
+                with metrics.span('ocr.merge'):
+                    outputs[i] = build_text_boxes(ocr_tiling.map_results(results, scale=prepared.pop(i)[1]))
+                if cache_keys[i] is not None:
+                    with metrics.span('ocr.cache_write'):
+                        ocr_cache.get_cache().put(cache_keys[i], outputs[i])
+    record_first_ocr(time.perf_counter() - start)
+    return outputs
+
+# 估算字体大小
+def estimate_font_size(bbox, height=None):
+    if height is None:
+        if not bbox:
+            return 1
+        height = np.linalg.norm(np.array(bbox[0]) - np.array(bbox[3]))
+    return max(1, int(height / 2))
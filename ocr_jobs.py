@@ -0,0 +1,304 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import metrics
+import ocr_engine
+
+logger = logging.getLogger(__name__)
+
+# 工作进程数量、每个用户同时运行/排队的任务上限、已完成任务的保留时间（秒）
+OCR_WORKERS = int(os.environ.get('OCR_WORKERS', min(2, os.cpu_count() or 1)))
+MAX_RUNNING_PER_USER = int(os.environ.get('OCR_MAX_RUNNING_PER_USER', 1))
+MAX_QUEUED_PER_USER = int(os.environ.get('OCR_MAX_QUEUED_PER_USER', 5))
+JOB_TTL_SECONDS = int(os.environ.get('OCR_JOB_TTL', 3600))
+# 整份文件识别时，每次送给工作进程的页数
+BATCH_PAGES = int(os.environ.get('OCR_BATCH_PAGES', 4))
+
+# 用户排队的任务超过上限
+class JobLimitError(Exception):
+    pass
+
+# 工作进程初始化：限制 torch 线程数并预先加载模型（langs、decoder、beam_width 为要使用的模型）
+def init_worker(threads, **model_kwargs):
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    ocr_engine.get_model(**model_kwargs)
+
+# 工作进程的耗时统计和模型加载记录，随每次的结果交给主进程合并
+def _worker_stats():
+    return {'metrics': metrics.drain(), 'models': ocr_engine.drain_model_stats()}
+
+def _merge_worker_stats(stats):
+    metrics.merge(stats['metrics'])
+    ocr_engine.merge_model_stats(stats['models'])
+
+# 在工作进程中预热模型（模型已由 init_worker 加载，这里再跑一次推理）
+def _warm_worker():
+    ocr_engine.warm_up()
+    return _worker_stats()
+
+def _warm_up_done(future):
+    if future.exception() is not None:
+        logger.warning("OCR 工作进程预热失败: %s", future.exception())
+    else:
+        _merge_worker_stats(future.result())
+
+# 在工作进程中批量执行 OCR，识别结果与本批次的统计一起返回
+def _run_ocr_batch(images, ocr_kwargs):
+    return ocr_engine.perform_ocr_batch(images, **ocr_kwargs), _worker_stats()
+
+# OCR 任务管理：进程池 + 按用户轮询的公平队列
+# 一个任务包含一页或多页，按 BATCH_PAGES 切分成若干批次调度
+class OcrJobManager:
+    def __init__(self, workers=OCR_WORKERS, max_running_per_user=MAX_RUNNING_PER_USER, max_queued_per_user=MAX_QUEUED_PER_USER):
+        self.workers = workers
+        self.max_running_per_user = max_running_per_user
+        self.max_queued_per_user = max_queued_per_user
+        self._pool = None
+        self._jobs = {}
+        self._pending = OrderedDict()
+        self._running = {}
+        self._active = 0
+        self._warmed = False
+        self._lock = threading.RLock()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                threads = max(1, (os.cpu_count() or 1) // self.workers)
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=init_worker,
+                    initargs=(threads,),
+                )
+            return self._pool
+
+    # 启动进程池并预热每个工作进程（只执行一次，之后的调用直接返回），首个用户无需等待模型加载
+    def warm_up(self):
+        with self._lock:
+            if self._warmed:
+                return
+            self._warmed = True
+            pool = self._get_pool()
+        # 同时提交与工作进程数相同的任务，进程池会启动全部工作进程
+        for _ in range(self.workers):
+            pool.submit(_warm_worker).add_done_callback(_warm_up_done)
+
+    # 重新加载模型（例如更新模型文件后）：换一个新的进程池，新工作进程重新加载并预热模型
+    # 旧进程池中正在执行的批次照常完成，之后旧工作进程退出
+    def reload_models(self):
+        with self._lock:
+            old, self._pool = self._pool, None
+            self._warmed = False
+            ocr_engine.forget_worker_models()
+        if old is not None:
+            old.shutdown(wait=False)
+        self.warm_up()
+
+    def _new_job(self, user, source, pages, ocr_kwargs, single):
+        return {
+            'id': uuid.uuid4().hex,
+            'user': user,
+            'status': 'queued',
+            'single': single,
+            'submitted': time.time(),
+            'started': None,
+            'finished': None,
+            'total': len(pages),
+            'done': 0,
+            'results': {},
+            'result': None,
+            'error': None,
+            'source': source,
+            'ocr_kwargs': ocr_kwargs,
+            'chunks_left': 0,
+        }
+
+    def _enqueue(self, job, chunks):
+        with self._lock:
+            self._purge()
+            queued = sum(1 for j in self._jobs.values() if j['user'] == job['user'] and j['status'] == 'queued')
+            if queued >= self.max_queued_per_user:
+                raise JobLimitError(f"用户 {job['user']} 排队中的任务已达上限 {self.max_queued_per_user}")
+            self._jobs[job['id']] = job
+            job['chunks_left'] = len(chunks)
+            queue = self._pending.setdefault(job['user'], deque())
+            queue.extend((job['id'], chunk) for chunk in chunks)
+            tasks = self._dispatch()
+        self._start(tasks)
+        return job['id']
+
+    # 提交单页 OCR 任务，返回任务 ID
+    def submit(self, user, image, **ocr_kwargs):
+        job = self._new_job(user, [image], [0], ocr_kwargs, single=True)
+        cached = ocr_engine.lookup_cached_ocr(image, **ocr_kwargs)
+        if cached is not None:
+            with self._lock:
+                job.update(status='done', result=cached, results={0: cached}, done=1, finished=time.time(), source=None)
+                self._jobs[job['id']] = job
+            return job['id']
+        return self._enqueue(job, [[0]])
+
+    # 提交整份文件的 OCR 任务；source 支持按索引取图（例如 read_pdf 的结果），在分派时才解码
+    def submit_batch(self, user, source, pages=None, **ocr_kwargs):
+        pages = list(range(len(source))) if pages is None else list(pages)
+        job = self._new_job(user, source, pages, ocr_kwargs, single=False)
+        chunks = [pages[i:i + BATCH_PAGES] for i in range(0, len(pages), BATCH_PAGES)]
+        return self._enqueue(job, chunks)
+
+    # 选出可以开始的批次（需持有锁）；用户之间轮流，
+    # 空闲的工作进程没有其他用户需要时，允许超过每用户的并发上限
+    def _dispatch(self):
+        tasks = []
+        while self._active < self.workers and self._pending:
+            user = next((u for u in self._pending if self._running.get(u, 0) < self.max_running_per_user), None)
+            if user is None:
+                user = next(iter(self._pending))
+            queue = self._pending.pop(user)
+            job_id, chunk = queue.popleft()
+            if queue:
+                self._pending[user] = queue
+            job = self._jobs[job_id]
+            if job['status'] == 'queued':
+                job['status'] = 'running'
+                job['started'] = time.time()
+                metrics.observe('ocr.queue_wait', job['started'] - job['submitted'])
+            self._running[user] = self._running.get(user, 0) + 1
+            self._active += 1
+            tasks.append((job, chunk))
+        return tasks
+
+    # 在锁外解码图片并提交到进程池
+    def _start(self, tasks):
+        for job, chunk in tasks:
+            try:
+                images = [job['source'][i] for i in chunk]
+                future = self._get_pool().submit(_run_ocr_batch, images, job['ocr_kwargs'])
+            except Exception as e:
+                if isinstance(e, BrokenProcessPool):
+                    self._pool = None
+                with self._lock:
+                    self._chunk_done(job, chunk, error=e)
+                    tasks_next = self._dispatch()
+                self._start(tasks_next)
+                continue
+            future.add_done_callback(lambda f, job=job, chunk=chunk: self._on_done(job, chunk, f))
+
+    def _on_done(self, job, chunk, future):
+        error = future.exception()
+        with self._lock:
+            if isinstance(error, BrokenProcessPool):
+                self._pool = None
+            results = None
+            if error is None:
+                results, worker_stats = future.result()
+                _merge_worker_stats(worker_stats)
+            self._chunk_done(job, chunk, results=results, error=error)
+            tasks = self._dispatch()
+        self._start(tasks)
+
+    def _chunk_done(self, job, chunk, results=None, error=None):
+        user = job['user']
+        self._running[user] -= 1
+        if self._running[user] <= 0:
+            del self._running[user]
+        self._active -= 1
+        job['chunks_left'] -= 1
+        if error is not None:
+            logger.warning("OCR 任务 %s 失败: %s", job['id'], error)
+            job['error'] = str(error)
+        else:
+            for page, text_boxes in zip(chunk, results):
+                job['results'][page] = text_boxes
+            job['done'] += len(chunk)
+            ocr_engine.record_first_ocr(time.time() - job['started'])
+        if job['chunks_left'] == 0 and job['status'] == 'running':
+            job['status'] = 'failed' if job['error'] and not job['results'] else 'done'
+            if job['single']:
+                job['result'] = job['results'].get(0)
+        if job['chunks_left'] == 0:
+            job['finished'] = time.time()
+            job['source'] = None
+            metrics.observe('ocr.job', job['finished'] - job['submitted'])
+
+    # 查询任务状态；整份文件的任务在 results 中逐页返回已完成的结果
+    def poll(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            info = {k: v for k, v in job.items() if k not in ('source', 'ocr_kwargs')}
+            info['results'] = dict(job['results'])
+            if job['status'] == 'queued':
+                pending = [j for j, _ in self._pending.get(job['user'], ())]
+                info['position'] = pending.index(job_id)
+        return info
+
+    # 取消任务中尚未开始的批次
+    def cancel(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job['status'] not in ('queued', 'running'):
+                return False
+            queue = self._pending.get(job['user'])
+            if queue:
+                remaining = deque(task for task in queue if task[0] != job_id)
+                job['chunks_left'] -= len(queue) - len(remaining)
+                if remaining:
+                    self._pending[job['user']] = remaining
+                else:
+                    del self._pending[job['user']]
+            job['status'] = 'cancelled'
+            if job['chunks_left'] == 0:
+                job['finished'] = time.time()
+                job['source'] = None
+        return True
+
+    # 结果已取走后删除任务
+    def forget(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None and job['finished']:
+                del self._jobs[job_id]
+
+    def _purge(self):
+        cutoff = time.time() - JOB_TTL_SECONDS
+        for job_id in [j for j, job in self._jobs.items() if job['finished'] and job['finished'] < cutoff]:
+            del self._jobs[job_id]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'running': self._active,
+                'queued': sum(len(q) for q in self._pending.values()),
+                'jobs': len(self._jobs),
+            }
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+
+_manager = None
+_manager_lock = threading.Lock()
+
+# 获取进程共享的任务管理器
+def get_job_manager():
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None:
+                _manager = OcrJobManager()
+    return _manager
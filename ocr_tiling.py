@@ -0,0 +1,159 @@
+import os
+import cv2
+import numpy as np
+
+# 识别时的目标字高（像素）：字比这个大的页面会先缩小再识别
+TARGET_GLYPH_HEIGHT = int(os.environ.get('OCR_TARGET_GLYPH_HEIGHT', 32))
+MIN_SCALE = 0.25
+# 单次检测允许的峰值内存（MB）与并行处理的分块数
+OCR_PEAK_MEMORY_MB = int(os.environ.get('OCR_PEAK_MEMORY_MB', 1024))
+TILE_THREADS = int(os.environ.get('OCR_TILE_THREADS', 2))
+# 检测模型每个输入像素大约占用的内存（字节），用于把内存上限换算成像素上限
+DETECTOR_BYTES_PER_PIXEL = 48
+# 估算字高时使用的缩略图长边
+_PROBE_SIZE = 1000
+
+# 每次检测允许的最大像素数（内存上限由并行的分块平分）
+def max_tile_pixels(peak_memory_mb=OCR_PEAK_MEMORY_MB, threads=TILE_THREADS):
+    return max(256 * 256, peak_memory_mb * 1024 * 1024 // DETECTOR_BYTES_PER_PIXEL // max(1, threads))
+
+# 用连通域估算页面上的字高（原图像素），文字太少时返回 None
+def estimate_glyph_height(gray):
+    h, w = gray.shape[:2]
+    probe_scale = min(1.0, _PROBE_SIZE / max(h, w))
+    small = gray
+    if probe_scale < 1.0:
+        small = cv2.resize(gray, (max(1, int(w * probe_scale)), max(1, int(h * probe_scale))), interpolation=cv2.INTER_AREA)
+    _, binary = cv2.threshold(small, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    count, _, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+    heights = stats[1:, cv2.CC_STAT_HEIGHT]
+    widths = stats[1:, cv2.CC_STAT_WIDTH]
+    # 去掉噪点、表格线和大块图形
+    keep = (heights >= 2) & (heights < small.shape[0] / 8) & (widths < small.shape[1] / 4) & (widths < heights * 8)
+    if keep.sum() < 20:
+        return None
+    return float(np.median(heights[keep])) / probe_scale
+
+# 根据字高选择工作分辨率（只缩小，不放大）
+def working_scale(gray, target_glyph_height=TARGET_GLYPH_HEIGHT):
+    glyph_height = estimate_glyph_height(gray)
+    if not glyph_height:
+        return 1.0
+    return float(min(1.0, max(MIN_SCALE, target_glyph_height / glyph_height)))
+
+# 把页面切成有重叠的分块，返回 (x, y, w, h) 列表
+def plan_tiles(height, width, max_pixels, overlap):
+    if height * width <= max_pixels:
+        return [(0, 0, width, height)]
+    side = max(int(np.sqrt(max_pixels)), overlap * 2 + 1)
+    step = side - overlap
+    xs = list(range(0, max(1, width - overlap), step))
+    ys = list(range(0, max(1, height - overlap), step))
+    return [(x, y, min(side, width - x), min(side, height - y)) for y in ys for x in xs]
+
+# 把分块中的识别框平移、缩放回原图坐标
+def map_results(results, offset_x=0, offset_y=0, scale=1.0):
+    mapped = []
+    for bbox, text, conf in results:
+        points = (np.asarray(bbox, dtype=np.float64) + (offset_x, offset_y)) / scale
+        mapped.append((np.rint(points).astype(int).tolist(), text, conf))
+    return mapped
+
+def _bbox_rect(bbox):
+    points = np.asarray(bbox, dtype=np.float64)
+    return points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max()
+
+# 框是否紧贴分块的内侧边（不是页面边缘的边），即可能被分块截断
+# 检测器不会输出只露出一部分的字，截断处与边之间可能空出约一个字宽，因此距离按框高计算
+def _touches_inner_edge(rect, tile, width, height, margin):
+    tx, ty, tw, th = tile
+    x0, y0, x1, y1 = rect
+    margin = max(margin, y1 - y0)
+    return ((tx > 0 and x0 <= tx + margin) or (tx + tw < width and x1 >= tx + tw - margin) or
+            (ty > 0 and y0 <= ty + margin) or (ty + th < height and y1 >= ty + th - margin))
+
+def _inside(rect, tile):
+    tx, ty, tw, th = tile
+    return rect[0] >= tx and rect[1] >= ty and rect[2] <= tx + tw and rect[3] <= ty + th
+
+# 拼接同一行上相邻的两段文字：去掉前一段结尾与后一段开头重复识别的部分
+def _join_text(left, right):
+    for k in range(min(len(left), len(right)), 0, -1):
+        if (k >= 2 or k == len(right)) and left.endswith(right[:k]):
+            return left + right[k:]
+    if right in left:
+        return left
+    separator = ' ' if left[-1:].isascii() and right[:1].isascii() and left[-1:].isalnum() and right[:1].isalnum() else ''
+    return left + separator + right
+
+# 合并各分块的识别结果（parts[i] 为第 i 个分块的结果，已平移到整页坐标）：
+# 1. 紧贴分块内侧边（可能被截断）的框，若完整位于另一个分块内且不靠近其内侧边，则丢弃（另一个分块有完整的结果）
+# 2. 其余跨越接缝的框中，同一行上相连的片段（至少一段被截断）或重复识别的框合并为一个框，文字按从左到右拼接
+def dedupe_results(parts, tiles, edge_margin=4):
+    if len(tiles) < 2:
+        return [r for part in parts for r in part]
+    width = max(x + w for x, _, w, _ in tiles)
+    height = max(y + h for _, y, _, h in tiles)
+    items = []
+    for t, part in enumerate(parts):
+        for result in part:
+            rect = _bbox_rect(result[0])
+            truncated = _touches_inner_edge(rect, tiles[t], width, height, edge_margin)
+            if truncated and any(_inside(rect, tile) and not _touches_inner_edge(rect, tile, width, height, edge_margin)
+                                 for o, tile in enumerate(tiles) if o != t):
+                continue
+            items.append((rect, result, t, truncated))
+
+    # 只有位于分块重叠区域（与多个分块相交）的框需要合并
+    def in_overlap(rect):
+        return sum(1 for x, y, w, h in tiles if rect[0] < x + w and rect[2] > x and rect[1] < y + h and rect[3] > y) > 1
+
+    # 按上边排序，下方的框上边超过当前框下边后不可能在同一行
+    candidates = sorted((i for i, item in enumerate(items) if in_overlap(item[0])), key=lambda i: items[i][0][1])
+    parent = list(range(len(items)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for n, i in enumerate(candidates):
+        a, _, tile_a, truncated_a = items[i]
+        for j in candidates[n + 1:]:
+            b, _, tile_b, truncated_b = items[j]
+            if b[1] >= a[3]:
+                break
+            if tile_a == tile_b:
+                continue
+            # 同一行：垂直方向重叠超过较矮框的一半
+            overlap_y = min(a[3], b[3]) - max(a[1], b[1])
+            if overlap_y < 0.5 * min(a[3] - a[1], b[3] - b[1]):
+                continue
+            overlap_x = min(a[2], b[2]) - max(a[0], b[0])
+            if overlap_x < -edge_margin:
+                continue
+            if truncated_a or truncated_b or overlap_x >= 0.5 * min(a[2] - a[0], b[2] - b[0]):
+                parent[find(j)] = find(i)
+
+    groups = {}
+    for i in range(len(items)):
+        groups.setdefault(find(i), []).append(items[i])
+    merged = []
+    for group in groups.values():
+        x0 = min(item[0][0] for item in group)
+        y0 = min(item[0][1] for item in group)
+        if len(group) == 1:
+            merged.append((y0, x0, group[0][1]))
+            continue
+        group.sort(key=lambda item: item[0][0])
+        text = group[0][1][1]
+        for item in group[1:]:
+            text = _join_text(text, item[1][1])
+        x1 = max(item[0][2] for item in group)
+        y1 = max(item[0][3] for item in group)
+        bbox = [[int(x0), int(y0)], [int(x1), int(y0)], [int(x1), int(y1)], [int(x0), int(y1)]]
+        merged.append((y0, x0, (bbox, text, min(item[1][2] for item in group))))
+    # 按从上到下、从左到右排序，接近 EasyOCR 整页识别时的顺序
+    merged.sort(key=lambda m: (m[0], m[1]))
+    return [result for _, _, result in merged]
@@ -0,0 +1,147 @@
+import cv2
+from text_render import fit_text, get_face, draw_lines
+
+TEXT_COLOR = (0, 0, 0)
+BACKGROUND_COLOR = (255, 255, 255)
+# 覆盖层的 font_size 约为文字像素高度的一半（与 OCR 估算的字号一致）
+FONT_SCALE = 2
+
+# 文字粗细度换算为描边宽度（像素），1、2 为常规字重
+def _stroke(thickness):
+    return max(0, (thickness - 1) // 2)
+
+# 由 OCR 的四点 bbox 建立一个文字覆盖层
+def make_overlay(bbox, text, font_size, thickness):
+    left = min(bbox[0][0], bbox[3][0])
+    top = min(bbox[0][1], bbox[1][1])
+    right = max(bbox[1][0], bbox[2][0])
+    bottom = max(bbox[2][1], bbox[3][1])
+    return {
+        'rect': (int(left), int(top), int(right), int(bottom)),
+        'text': text,
+        'font_size': font_size,
+        'thickness': thickness,
+    }
+
+# 覆盖层的排版：字号不超过 font_size 对应的像素大小，并自动缩小到文字能放进 bbox
+# 返回 (字体, 行列表)；排版结果保存在覆盖层中，重绘时不再重新排版
+def _layout(overlay):
+    stroke = _stroke(overlay['thickness'])
+    if 'layout' not in overlay:
+        left, top, right, bottom = overlay['rect']
+        overlay['layout'] = fit_text(overlay['text'], right - left, bottom - top, overlay['font_size'] * FONT_SCALE, stroke)
+    size, lines = overlay['layout']
+    return get_face(size, stroke), lines
+
+# 覆盖层实际绘制的范围（bbox 加上超出 bbox 的文字），用于局部重绘
+def overlay_extent(overlay):
+    x0, y0, x1, y1 = overlay['rect']
+    face, lines = _layout(overlay)
+    left, top, right, bottom = face.extent(lines)
+    return min(x0, x0 + left), min(y0, y0 + top), max(x1, x0 + right) + 1, max(y1, y0 + bottom) + 1
+
+# 在画布上绘制覆盖层；canvas 可以是整页的一部分，origin 为其左上角在整页中的坐标
+def draw_overlay(canvas, overlay, origin=(0, 0)):
+    ox, oy = origin
+    left, top, right, bottom = overlay['rect']
+    # 删除原来的区域
+    cv2.rectangle(canvas, (left - ox, top - oy), (right - ox, bottom - oy), BACKGROUND_COLOR, -1)
+    # 添加新的文本
+    face, lines = _layout(overlay)
+    draw_lines(canvas, face, lines, left - ox, top - oy, TEXT_COLOR)
+
+def _intersects(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+# 单页的编辑记录：覆盖层列表 + 合成后的页面缓存
+# 新增、复原、重做时只重绘受影响的矩形区域，不保存整页快照
+# 传入 store（PageStore）时合成页面由它保管，可被换出到磁盘
+class PageEdits:
+    def __init__(self, store=None, key=None):
+        self.overlays = []
+        self.undone = []
+        self._store = store
+        self._key = key
+        self._composite = None
+
+    def can_undo(self):
+        return bool(self.overlays)
+
+    def can_redo(self):
+        return bool(self.undone)
+
+    def _load(self, base):
+        composite = self._store.get(self._key) if self._store is not None else self._composite
+        if composite is not None and composite.shape != base.shape:
+            return None
+        return composite
+
+    def _save(self, composite):
+        if self._store is None:
+            self._composite = composite
+        elif composite is None:
+            self._store.discard(self._key)
+        else:
+            self._store.put(self._key, composite)
+
+    # 返回合成后的页面；没有编辑时直接返回底图
+    def render(self, base):
+        if not self.overlays:
+            self._save(None)
+            return base
+        composite = self._load(base)
+        if composite is None:
+            composite = base.copy()
+            for overlay in self.overlays:
+                draw_overlay(composite, overlay)
+            self._save(composite)
+        return composite
+
+    def add(self, base, overlay):
+        overlay['extent'] = overlay_extent(overlay)
+        self.undone.clear()
+        self.overlays.append(overlay)
+        composite = self._load(base)
+        if composite is not None:
+            draw_overlay(composite, overlay)
+            self._save(composite)
+        return self.render(base)
+
+    def undo(self, base):
+        if self.overlays:
+            overlay = self.overlays.pop()
+            self.undone.append(overlay)
+            self._repaint(base, overlay['extent'])
+        return self.render(base)
+
+    def redo(self, base):
+        if self.undone:
+            overlay = self.undone.pop()
+            self.overlays.append(overlay)
+            composite = self._load(base)
+            if composite is not None:
+                draw_overlay(composite, overlay)
+                self._save(composite)
+        return self.render(base)
+
+    def clear(self):
+        self.overlays = []
+        self.undone = []
+        self._save(None)
+
+    # 用底图恢复脏矩形，再按顺序重绘与之相交的覆盖层
+    def _repaint(self, base, rect):
+        composite = self._load(base)
+        if composite is None:
+            return
+        height, width = base.shape[:2]
+        x0, y0 = max(0, rect[0]), max(0, rect[1])
+        x1, y1 = min(width, rect[2]), min(height, rect[3])
+        if x0 >= x1 or y0 >= y1:
+            return
+        view = composite[y0:y1, x0:x1]
+        view[...] = base[y0:y1, x0:x1]
+        for overlay in self.overlays:
+            if _intersects(overlay['extent'], (x0, y0, x1, y1)):
+                draw_overlay(view, overlay, (x0, y0))
+        self._save(composite)
@@ -0,0 +1,159 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import weakref
+from itertools import count
+import cv2
+
+logger = logging.getLogger(__name__)
+
+# 每个 session 和整个进程可常驻内存的页面数据上限（MB）
+SESSION_BUDGET_MB = int(os.environ.get('PAGE_STORE_SESSION_MB', 128))
+GLOBAL_BUDGET_MB = int(os.environ.get('PAGE_STORE_GLOBAL_MB', 1024))
+# 换出文件所在目录（默认为系统临时目录）
+SPILL_DIR = os.environ.get('PAGE_STORE_SPILL_DIR') or None
+
+# 所有 session 的页面存储共用一把锁，便于按全局预算换出
+_lock = threading.RLock()
+_stores = weakref.WeakSet()
+# 页面存储的编号（同一用户可能同时有多个 session，指标以编号区分）
+_store_ids = count(1)
+
+# 单个 session 的页面存储：超出预算时把最久未使用的页面压缩写入本地文件，访问时自动读回
+class PageStore:
+    def __init__(self, name="", session_budget=SESSION_BUDGET_MB * 1024 * 1024):
+        self.name = name
+        self.id = next(_store_ids)
+        self.session_budget = session_budget
+        self.resident_bytes = 0
+        self.spilled_bytes = 0
+        self.spills = 0
+        self.reloads = 0
+        self._resident = {}
+        self._spilled = {}
+        self._last_used = {}
+        self._dir = None
+        self._finalizer = None
+        with _lock:
+            _stores.add(self)
+
+    def _spill_path(self, key):
+        if self._dir is None:
+            self._dir = tempfile.mkdtemp(prefix='page_store_', dir=SPILL_DIR)
+            self._finalizer = weakref.finalize(self, shutil.rmtree, self._dir, True)
+        return os.path.join(self._dir, f"{key}.png")
+
+    def put(self, key, array):
+        with _lock:
+            self._drop(key)
+            self._resident[key] = array
+            self.resident_bytes += array.nbytes
+            self._last_used[key] = time.monotonic()
+            self._enforce_session_budget(keep=key)
+            _enforce_global_budget(keep=(self, key))
+
+    def get(self, key):
+        with _lock:
+            array = self._resident.get(key)
+            if array is None:
+                path = self._spilled.get(key)
+                if path is None:
+                    return None
+                array = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+                self._drop(key)
+                self.reloads += 1
+                self._resident[key] = array
+                self.resident_bytes += array.nbytes
+                self._enforce_session_budget(keep=key)
+                _enforce_global_budget(keep=(self, key))
+            self._last_used[key] = time.monotonic()
+            return array
+
+    def __contains__(self, key):
+        with _lock:
+            return key in self._resident or key in self._spilled
+
+    def discard(self, key):
+        with _lock:
+            self._drop(key)
+            self._last_used.pop(key, None)
+
+    def clear(self):
+        with _lock:
+            for key in list(self._last_used):
+                self.discard(key)
+
+    def _drop(self, key):
+        array = self._resident.pop(key, None)
+        if array is not None:
+            self.resident_bytes -= array.nbytes
+        path = self._spilled.pop(key, None)
+        if path is not None:
+            self.spilled_bytes -= os.path.getsize(path)
+            os.remove(path)
+
+    # 把页面压缩成 PNG（无损）写入文件并释放内存；读回时按原样还原，不涉及颜色通道顺序
+    def _spill(self, key):
+        array = self._resident.pop(key)
+        path = self._spill_path(key)
+        cv2.imwrite(path, array, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        self._spilled[key] = path
+        self.resident_bytes -= array.nbytes
+        self.spilled_bytes += os.path.getsize(path)
+        self.spills += 1
+        logger.debug("页面 %s/%s 已换出到 %s", self.name, key, path)
+
+    def _enforce_session_budget(self, keep=None):
+        while self.resident_bytes > self.session_budget:
+            candidates = [k for k in self._resident if k != keep]
+            if not candidates:
+                break
+            self._spill(min(candidates, key=self._last_used.get))
+
+    def stats(self):
+        with _lock:
+            return {
+                'name': self.name,
+                'id': self.id,
+                'resident_bytes': self.resident_bytes,
+                'resident_pages': len(self._resident),
+                'spilled_bytes': self.spilled_bytes,
+                'spilled_pages': len(self._spilled),
+                'spills': self.spills,
+                'reloads': self.reloads,
+            }
+
+    def close(self):
+        with _lock:
+            self.clear()
+            _stores.discard(self)
+            if self._finalizer is not None:
+                self._finalizer()
+
+# 全局超出预算时，在所有 session 中换出最久未使用的页面
+def _enforce_global_budget(keep=None):
+    budget = GLOBAL_BUDGET_MB * 1024 * 1024
+    stores = list(_stores)
+    total = sum(store.resident_bytes for store in stores)
+    while total > budget:
+        candidates = [(store._last_used[key], store, key) for store in stores for key in store._resident if (store, key) != keep]
+        if not candidates:
+            break
+        _, store, key = min(candidates, key=lambda item: item[0])
+        before = store.resident_bytes
+        store._spill(key)
+        total -= before - store.resident_bytes
+
+# 所有 session 的常驻内存统计
+def global_stats():
+    with _lock:
+        sessions = [store.stats() for store in _stores]
+    return {
+        'resident_bytes': sum(s['resident_bytes'] for s in sessions),
+        'spilled_bytes': sum(s['spilled_bytes'] for s in sessions),
+        'budget_bytes': GLOBAL_BUDGET_MB * 1024 * 1024,
+        'sessions': sessions,
+    }
@@ -0,0 +1,199 @@
+import logging
+import os
+import tempfile
+import weakref
+import cv2
+import fitz  # PyMuPDF
+import metrics
+from text_render import is_cjk
+
+logger = logging.getLogger(__name__)
+
+# 导出文件所在目录（默认为系统临时目录）
+EXPORT_DIR = os.environ.get('PDF_EXPORT_DIR') or None
+# 编辑区域的文字放不下时逐步缩小字号，最小到 MIN_FONT_SIZE（pt）
+MIN_FONT_SIZE = 4
+FONT_SHRINK = 0.85
+# 拉丁文字使用 Helvetica，含中日韩文字时使用 PyMuPDF 内置的 CJK 字体
+LATIN_FONT = 'helv'
+CJK_FONT = 'china-s'
+
+def _font_for(text):
+    return CJK_FONT if any(map(is_cjk, text)) else LATIN_FONT
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+# 导出的临时文件：对象被回收（例如 session 结束）或调用 discard 时删除
+class ExportFile:
+    def __init__(self):
+        fd, self.path = tempfile.mkstemp(prefix='export_', suffix='.pdf', dir=EXPORT_DIR)
+        os.close(fd)
+        self._finalizer = weakref.finalize(self, _remove, self.path)
+
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def open(self):
+        return open(self.path, 'rb')
+
+    def discard(self):
+        self._finalizer()
+
+# 四点 bbox 的外接矩形
+def _bbox_rect(bbox):
+    xs = [point[0] for point in bbox]
+    ys = [point[1] for point in bbox]
+    return min(xs), min(ys), max(xs), max(ys)
+
+def _rect_quad(rect):
+    left, top, right, bottom = rect
+    return [(left, top), (right, top), (right, bottom), (left, bottom)]
+
+def _contains(outer, inner):
+    return outer[0] <= inner[0] and outer[1] <= inner[1] and outer[2] >= inner[2] and outer[3] >= inner[3]
+
+def _intersects(a, b):
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+# 只保留最终可见的覆盖层：被之后的覆盖层完全盖住的覆盖层不再输出
+def _visible_overlays(overlays):
+    visible = []
+    for overlay in overlays:
+        visible = [o for o in visible if not _contains(overlay['rect'], o['rect'])]
+        visible.append(overlay)
+    return visible
+
+# 在矩形内写入文字，放不下时缩小字号；rect 为已旋转的页面坐标
+# 字号不超过矩形高度，文字框向下留出行距，使单行文字可以写满原来的区域
+def _insert_fitted(page, rect, text, fontsize):
+    fontname = _font_for(text)
+    fontsize = min(fontsize, rect.height)
+    while fontsize >= MIN_FONT_SIZE:
+        box = fitz.Rect(rect.x0, rect.y0, rect.x1, rect.y1 + fontsize * 0.5)
+        if page.insert_textbox(box * page.derotation_matrix, text, fontname=fontname, fontsize=fontsize, rotate=page.rotation) >= 0:
+            return
+        fontsize *= FONT_SHRINK
+    # 最小字号仍放不下时，向下延伸到页面底部
+    extended = fitz.Rect(rect.x0, rect.y0, rect.x1, max(rect.y1, page.rect.y1))
+    if page.insert_textbox(extended * page.derotation_matrix, text, fontname=fontname, fontsize=MIN_FONT_SIZE, rotate=page.rotation) < 0:
+        logger.warning("第 %d 页的文字放不下，已截断: %r", page.number + 1, text[:20])
+
+# 用白色涂掉编辑区域（包括区域内的图片像素和原有文字），再以文字对象写入编辑后的文字
+def _replace_regions(page, pages, idx, overlays):
+    overlays = _visible_overlays(overlays)
+    scale = pages.pixel_transform(idx)[3]
+    rects = [pages.page_rect(idx, overlay['rect']) for overlay in overlays]
+    for rect in rects:
+        page.add_redact_annot(rect * page.derotation_matrix, fill=(1, 1, 1))
+    page.apply_redactions()
+    for rect, overlay in zip(rects, overlays):
+        # 覆盖层的 font_size 约为文字像素高度的一半
+        _insert_fitted(page, rect, overlay['text'], max(MIN_FONT_SIZE, 2 * overlay['font_size'] / scale))
+
+# 在 OCR 识别到的位置写入不可见文字（render_mode=3），使页面可以搜索和选取
+# 与编辑区域相交的识别结果已被编辑后的文字取代，不再写入（skip 为编辑区域）
+def _add_text_layer(page, pages, idx, text_boxes, skip=()):
+    for bbox, text, _ in text_boxes:
+        if not text.strip():
+            continue
+        pixel_rect = _bbox_rect(bbox)
+        if any(_intersects(rect, pixel_rect) for rect in skip):
+            continue
+        rect = pages.page_rect(idx, pixel_rect)
+        fontname = _font_for(text)
+        fontsize = rect.height / 1.4
+        if fontsize <= 0:
+            continue
+        length = fitz.get_text_length(text, fontname=fontname, fontsize=fontsize)
+        stretch = rect.width / length if length else 1
+        matrix = fitz.Matrix(1, stretch) if page.rotation % 180 else fitz.Matrix(stretch, 1)
+        point = fitz.Point(rect.x0, rect.y1 - 0.3 * fontsize) * page.derotation_matrix
+        page.insert_text(point, text, fontname=fontname, fontsize=fontsize, render_mode=3,
+                         rotate=page.rotation, morph=(point, matrix))
+
+# 以图片输出编辑后的页面（与画面上看到的一致），取代第 idx 页
+def _raster_page(out, pages, idx, image):
+    entry = pages.metadata(idx)
+    out.delete_page(idx)
+    page = out.new_page(pno=idx, width=entry['width'], height=entry['height'])
+    height, width = image.shape[:2]
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+    ok, png = cv2.imencode('.png', image)
+    if not ok:
+        raise ValueError(f"第 {idx + 1} 页无法编码为 PNG")
+    page.insert_image(pages.page_rect(idx, (0, 0, width, height)), stream=png.tobytes())
+    return page
+
+# 写入修改过的页面后关闭文件再重新打开，已写入的对象不再留在内存中
+def _flush(out, path):
+    out.save(path, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP, deflate=True)
+    out.close()
+    fitz.TOOLS.store_shrink(100)
+    return fitz.open(path)
+
+# 导出编辑后的 PDF 到 path：先以一次 insert_pdf 复制所有页面（共用资源只保留一份）并写入文件，
+# 再逐页修改，每改完一页以增量保存写入文件，内存占用不随页数增长；最后整理一次文件，去掉被取代的对象
+# mode='text'：编辑区域以 redaction 涂白后写入文字对象
+# mode='image'：编辑过的页面以图片输出，其余页面原样复制
+# text_layer=True 时为没有文字层（或已转为图片）的页面加入 OCR 结果的不可见文字
+@metrics.timed('pdf.export')
+def export_pdf(pages, path, edits=None, ocr_results=None, mode='text', text_layer=True, progress=None):
+    edits = edits or {}
+    ocr_results = ocr_results or {}
+    total = len(pages)
+    out = fitz.open()
+    try:
+        pages.copy_pages(out)
+        out.save(path, deflate=True)
+    finally:
+        out.close()
+    fitz.TOOLS.store_shrink(100)
+    changed = False
+    out = fitz.open(path)
+    try:
+        for idx in range(total):
+            page_edits = edits.get(idx)
+            overlays = list(page_edits.overlays) if page_edits else []
+            rasterized = bool(overlays) and mode == 'image'
+            ocr_layer = text_layer and idx in ocr_results and (rasterized or not pages.has_text(idx))
+            if not overlays and not ocr_layer:
+                if progress is not None:
+                    progress(idx + 1, total)
+                continue
+            if rasterized:
+                page = _raster_page(out, pages, idx, page_edits.render(pages[idx]))
+            else:
+                page = out[idx]
+                if overlays:
+                    _replace_regions(page, pages, idx, overlays)
+            if ocr_layer:
+                _add_text_layer(page, pages, idx, ocr_results[idx], [overlay['rect'] for overlay in overlays])
+            if text_layer and rasterized:
+                # 转为图片的编辑区域同样加入不可见文字
+                _add_text_layer(page, pages, idx, [(_rect_quad(o['rect']), o['text'], o['font_size']) for o in _visible_overlays(overlays)])
+            del page
+            out = _flush(out, path)
+            changed = True
+            if progress is not None:
+                progress(idx + 1, total)
+    finally:
+        if not out.is_closed:
+            out.close()
+    if changed:
+        # 重新写入整个文件：去掉增量保存中被取代的页面和内容（garbage=1）
+        fd, tmp = tempfile.mkstemp(suffix='.pdf', dir=os.path.dirname(os.path.abspath(path)))
+        os.close(fd)
+        try:
+            with fitz.open(path) as out:
+                out.save(tmp, garbage=1, deflate=True)
+            os.replace(tmp, path)
+        except BaseException:
+            _remove(tmp)
+            raise
+        fitz.TOOLS.store_shrink(100)
+    return path
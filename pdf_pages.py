@@ -0,0 +1,426 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import fitz  # PyMuPDF
+import numpy as np
+import image_pipeline
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# 已解码图片缓存的内存上限（MB），以及同时保留索引的 PDF 文件数
+IMAGE_CACHE_MB = int(os.environ.get('PDF_IMAGE_CACHE_MB', 256))
+MAX_CACHED_DOCUMENTS = int(os.environ.get('PDF_CACHED_DOCUMENTS', 8))
+# 页面栅格化的默认解析度，以及可选的解析度
+RENDER_DPI = int(os.environ.get('PDF_RENDER_DPI', 150))
+DPI_CHOICES = (72, 100, 150, 200, 300)
+# 单张图片覆盖页面面积的比例达到此值时视为整页扫描，直接使用原始图片
+FULL_BLEED_COVERAGE = 0.95
+# 原始图片可直接解码的压缩格式（JBIG2、CCITT 传真等 OpenCV/PIL 无法解码的格式改为栅格化页面）
+NATIVE_FILTERS = {'/DCTDecode', '/FlateDecode', '/LZWDecode', '/RunLengthDecode', '/JPXDecode'}
+# 文字层的字数及单词覆盖页面面积的比例都达到此值时才视为有文字层（只有页码、印章等少量文字的扫描页仍需 OCR）
+MIN_TEXT_CHARS = int(os.environ.get('PDF_MIN_TEXT_CHARS', 40))
+MIN_TEXT_COVERAGE = float(os.environ.get('PDF_MIN_TEXT_COVERAGE', 0.01))
+# 缩略图的宽度（像素）和缩略图缓存的内存上限（MB）
+THUMBNAIL_WIDTH = int(os.environ.get('PDF_THUMBNAIL_WIDTH', 120))
+THUMBNAIL_CACHE_MB = int(os.environ.get('PDF_THUMBNAIL_CACHE_MB', 64))
+# 后台预取相邻页面的线程数
+PREFETCH_THREADS = int(os.environ.get('PDF_PREFETCH_THREADS', 1))
+
+# 已解码图片占用的字节数
+def image_nbytes(image):
+    if hasattr(image, 'nbytes'):
+        return image.nbytes
+    return image.width * image.height * len(image.getbands())
+
+# 按字节预算淘汰的 LRU 图片缓存
+class ImageLRU:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, image):
+        nbytes = image_nbytes(image)
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.resident_bytes -= old[1]
+            self._items[key] = (image, nbytes)
+            self.resident_bytes += nbytes
+            self._evict()
+
+    # 只检查是否已缓存，不影响命中统计和淘汰顺序
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def set_budget(self, max_bytes):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    # 删除某个 PDF 的所有已解码图片
+    def discard_document(self, digest):
+        with self._lock:
+            for key in [k for k in self._items if k[0] == digest]:
+                self.resident_bytes -= self._items.pop(key)[1]
+
+    def _evict(self):
+        # 至少保留最近使用的一张，避免单张超大图片反复解码
+        while self.resident_bytes > self.max_bytes and len(self._items) > 1:
+            _, (_, nbytes) = self._items.popitem(last=False)
+            self.resident_bytes -= nbytes
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._items),
+                'resident_bytes': self.resident_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+image_cache = ImageLRU(IMAGE_CACHE_MB * 1024 * 1024)
+thumbnail_cache = ImageLRU(THUMBNAIL_CACHE_MB * 1024 * 1024)
+
+# 预取相邻页面的后台线程，以及正在预取的页面（缓存键 -> Future）
+_prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_THREADS, thread_name_prefix='pdf_prefetch')
+_prefetching = {}
+_prefetch_lock = threading.Lock()
+
+def _pixmap_array(pix):
+    return np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width, pix.n)
+
+# 一份已打开的 PDF：打开时只建立页面索引，文字层在第一次需要时读取并缓存
+class PdfDocument:
+    def __init__(self, digest, document, entries):
+        self.digest = digest
+        self.entries = entries
+        self._document = document
+        self._words = {}
+        self._lock = threading.Lock()
+        self._thumbnail_thread = None
+        self.thumbnails_rendered = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _image_key(self, idx, dpi):
+        return (self.digest, idx, None if self.entries[idx]['native'] else dpi)
+
+    # 第 idx 页的像素：整页扫描直接解码原始图片，其余页面按 dpi 栅格化
+    # 该页正在后台预取时等待预取完成，不重复解码
+    def image(self, idx, dpi):
+        key = self._image_key(idx, dpi)
+        image = image_cache.get(key)
+        if image is None:
+            with _prefetch_lock:
+                future = _prefetching.get(key)
+            image = future.result() if future is not None else self._load_image(idx, dpi)
+        return image
+
+    def _load_image(self, idx, dpi):
+        native = self.entries[idx]['native']
+        image = self._decode_native(native) if native else self._render(idx, dpi)
+        image_cache.put(self._image_key(idx, dpi), image)
+        return image
+
+    # 在后台解码第 idx 页并放入缓存
+    def prefetch(self, idx, dpi):
+        key = self._image_key(idx, dpi)
+        with _prefetch_lock:
+            if key in _prefetching or key in image_cache:
+                return
+            _prefetching[key] = _prefetch_executor.submit(self._prefetch, key, idx, dpi)
+
+    def _prefetch(self, key, idx, dpi):
+        try:
+            return self._load_image(idx, dpi)
+        finally:
+            with _prefetch_lock:
+                _prefetching.pop(key, None)
+
+    @metrics.timed('pdf.decode_native')
+    def _decode_native(self, native):
+        with self._lock:
+            base_image = self._document.extract_image(native['xref'])
+        return image_pipeline.decode_image(base_image["image"])
+
+    @metrics.timed('pdf.render')
+    def _render(self, idx, dpi):
+        with self._lock:
+            pix = self._document.load_page(idx).get_pixmap(dpi=dpi, alpha=False)
+        return _pixmap_array(pix)
+
+    # 第 idx 页的缩略图（宽 THUMBNAIL_WIDTH 像素），直接以低解析度栅格化
+    def thumbnail(self, idx):
+        key = (self.digest, idx)
+        thumbnail = thumbnail_cache.get(key)
+        if thumbnail is None:
+            with self._lock:
+                page = self._document.load_page(idx)
+                zoom = THUMBNAIL_WIDTH / page.rect.width
+                pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+            thumbnail = _pixmap_array(pix)
+            thumbnail_cache.put(key, thumbnail)
+        return thumbnail
+
+    # 在后台线程中依次生成所有页面的缩略图（每份文件只启动一次）
+    def start_thumbnails(self):
+        with self._lock:
+            if self._thumbnail_thread is not None:
+                return
+            self._thumbnail_thread = threading.Thread(target=self._render_thumbnails, name=f'pdf_thumbnails_{self.digest[:8]}', daemon=True)
+        self._thumbnail_thread.start()
+
+    def _render_thumbnails(self):
+        try:
+            for idx in range(len(self)):
+                self.thumbnail(idx)
+                self.thumbnails_rendered = idx + 1
+        except Exception as e:
+            # 文件已关闭等情况，缩略图会在显示时再生成
+            logger.debug("生成缩略图中止: %s", e)
+
+    def copy_pages(self, target):
+        with self._lock:
+            target.insert_pdf(self._document)
+
+    # 第 idx 页文字层中的单词（页面坐标，已按页面旋转转换）
+    def words(self, idx):
+        with self._lock:
+            words = self._words.get(idx)
+            if words is None:
+                with metrics.span('pdf.text_layer'):
+                    page = self._document.load_page(idx)
+                    rotation = page.rotation_matrix
+                    words = self._words[idx] = [(fitz.Rect(w[:4]) * rotation, w[4]) for w in page.get_text("words") if w[4].strip()]
+        return words
+
+    def close(self):
+        with self._lock:
+            self._document.close()
+
+# 按指定解析度访问 PDF 的页面：每一项是一整页（不是页面中的图片），像素在访问时才生成
+# 同一份 PDF 的不同解析度共用同一个 PdfDocument
+class PdfPages:
+    def __init__(self, document, dpi=RENDER_DPI):
+        self.document = document
+        self.dpi = dpi
+
+    @property
+    def digest(self):
+        return self.document.digest
+
+    def __len__(self):
+        return len(self.document)
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        return self.document.image(idx, self.dpi)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    # 返回第 idx 页的元数据（页码、尺寸、旋转角度、图片数量、整页扫描图片）
+    def metadata(self, idx):
+        return self.document.entries[idx]
+
+    def thumbnail(self, idx):
+        return self.document.thumbnail(idx)
+
+    def start_thumbnails(self):
+        self.document.start_thumbnails()
+
+    # 在后台预先解码指定的页面（超出范围的页码会被忽略）
+    def prefetch(self, indices):
+        for idx in indices:
+            if 0 <= idx < len(self):
+                self.document.prefetch(idx, self.dpi)
+
+    # 页面是否直接使用原始的扫描图片
+    def is_native(self, idx):
+        return self.document.entries[idx]['native'] is not None
+
+    # 页面是否有足够的文字层（有则无需 OCR）
+    def has_text(self, idx):
+        words = self.document.words(idx)
+        if sum(len(text) for _, text in words) < MIN_TEXT_CHARS:
+            return False
+        entry = self.document.entries[idx]
+        covered = sum(rect.get_area() for rect, _ in words)
+        return covered >= MIN_TEXT_COVERAGE * entry['width'] * entry['height']
+
+    # 文字层中的单词，格式与 EasyOCR 的识别结果相同：(四点 bbox, 文字, 置信度)，坐标为页面图像的像素
+    def text_results(self, idx):
+        x0, y0, sx, sy = self.pixel_transform(idx)
+        results = []
+        for rect, text in self.document.words(idx):
+            left, top = (rect.x0 - x0) * sx, (rect.y0 - y0) * sy
+            right, bottom = (rect.x1 - x0) * sx, (rect.y1 - y0) * sy
+            results.append(([[left, top], [right, top], [right, bottom], [left, bottom]], text, 1.0))
+        return results
+
+    # 页面坐标到页面图像像素的换算：像素 = (页面坐标 - 原点) * 比例
+    def pixel_transform(self, idx):
+        native = self.document.entries[idx]['native']
+        if native:
+            x0, y0, x1, y1 = native['rect']
+            return x0, y0, native['width'] / (x1 - x0), native['height'] / (y1 - y0)
+        return 0, 0, self.dpi / 72, self.dpi / 72
+
+    # 把页面图像上的像素矩形换算回页面坐标（已旋转的页面坐标，与 text_results 相同）
+    def page_rect(self, idx, rect):
+        x0, y0, sx, sy = self.pixel_transform(idx)
+        left, top, right, bottom = rect
+        return fitz.Rect(left / sx + x0, top / sy + y0, right / sx + x0, bottom / sy + y0)
+
+    # 把所有页面一次复制到另一个 PDF 的末尾（共用的字体、图片等资源只复制一份）
+    def copy_pages(self, target):
+        self.document.copy_pages(target)
+
+    # 关闭文件并释放它的图片和缩略图缓存
+    def close(self):
+        self.document.close()
+        image_cache.discard_document(self.digest)
+        thumbnail_cache.discard_document(self.digest)
+
+_documents = OrderedDict()
+_documents_lock = threading.Lock()
+# 上传文件（按 Streamlit 的 file_id）对应的内容哈希，重新运行页面时不必重新计算
+_upload_digests = OrderedDict()
+MAX_UPLOAD_DIGESTS = 256
+
+# 获取上传文件的内容
+def _read_bytes(file):
+    if isinstance(file, (bytes, bytearray)):
+        return bytes(file)
+    if hasattr(file, 'getvalue'):
+        return file.getvalue()
+    return file.read()
+
+# 计算 PDF 内容的 SHA-256
+def pdf_digest(data):
+    return hashlib.sha256(data).hexdigest()
+
+# 原始图片能否直接解码：压缩格式可解码，且没有 /Decode 数组（反相等）、不是模板遮罩
+def _decodable_image(document, xref):
+    kind, value = document.xref_get_key(xref, 'Filter')
+    filters = value.strip('[]').split() if kind != 'null' else []
+    if any(f not in NATIVE_FILTERS for f in filters):
+        return False
+    if document.xref_get_key(xref, 'Decode')[0] != 'null':
+        return False
+    return document.xref_get_key(xref, 'ImageMask')[1] != 'true'
+
+# 判断页面是否为整页扫描：只有一张不透明、未旋转、可直接解码的图片，铺满页面，且页面上没有文字和矢量图形
+# 返回原始图片的 xref、像素尺寸和它在页面上的位置，否则返回 None
+def _native_image(page):
+    if page.rotation or page.first_annot is not None:
+        return None
+    images = page.get_images(full=True)
+    if len(images) != 1:
+        return None
+    xref, smask, width, height = images[0][:4]
+    if smask:
+        return None
+    placements = page.get_image_rects(xref, transform=True)
+    if len(placements) != 1:
+        return None
+    rect, matrix = placements[0]
+    if matrix.b or matrix.c or matrix.a <= 0 or matrix.d <= 0:
+        return None
+    if (rect & page.rect).get_area() < FULL_BLEED_COVERAGE * page.rect.get_area():
+        return None
+    if not _decodable_image(page.parent, xref):
+        return None
+    # 印章、页码等叠加在图片上的文字或图形只有栅格化页面才会出现在图像中
+    if page.get_text().strip() or page.get_drawings():
+        return None
+    return {'xref': xref, 'width': width, 'height': height, 'rect': tuple(rect)}
+
+# 建立页面索引（不解码、不栅格化）
+def _index_pages(pdf_document):
+    entries = []
+    for page_num in range(len(pdf_document)):
+        page = pdf_document.load_page(page_num)
+        entries.append({
+            'page': page_num,
+            'width': page.rect.width,
+            'height': page.rect.height,
+            'rotation': page.rotation,
+            'images': len(page.get_images()),
+            'native': _native_image(page),
+        })
+    return entries
+
+# 上传文件的内容哈希；有 file_id 时只在第一次计算
+def _file_digest(file, data):
+    file_id = getattr(file, 'file_id', None)
+    if file_id is None:
+        return pdf_digest(data)
+    with _documents_lock:
+        digest = _upload_digests.get(file_id)
+    if digest is None:
+        digest = pdf_digest(data)
+        with _documents_lock:
+            _upload_digests[file_id] = digest
+            while len(_upload_digests) > MAX_UPLOAD_DIGESTS:
+                _upload_digests.popitem(last=False)
+    return digest
+
+# 打开PDF文件（按内容哈希缓存；cache=False 时不缓存，用完由调用方关闭）
+def _open_document(data, digest, cache=True):
+    if not cache:
+        pdf_document = fitz.open(stream=data, filetype="pdf")
+        return PdfDocument(digest, pdf_document, _index_pages(pdf_document))
+    with _documents_lock:
+        document = _documents.get(digest)
+        if document is not None:
+            _documents.move_to_end(digest)
+            return document
+
+    pdf_document = fitz.open(stream=data, filetype="pdf")
+    document = PdfDocument(digest, pdf_document, _index_pages(pdf_document))
+
+    with _documents_lock:
+        existing = _documents.get(digest)
+        if existing is not None:
+            document.close()
+            return existing
+        _documents[digest] = document
+        while len(_documents) > MAX_CACHED_DOCUMENTS:
+            _, evicted = _documents.popitem(last=False)
+            # 不主动关闭文档：可能仍有 session 持有它，交给垃圾回收
+            image_cache.discard_document(evicted.digest)
+            thumbnail_cache.discard_document(evicted.digest)
+    return document
+
+# 读取PDF文件并返回所有页面（每页一项，按需以 dpi 栅格化或解码原始扫描图片）
+# 批量处理时可传 cache=False，处理完调用 close() 释放
+@metrics.timed('pdf.read')
+def read_pdf(file, dpi=RENDER_DPI, cache=True):
+    data = _read_bytes(file)
+    return PdfPages(_open_document(data, _file_digest(file, data), cache), dpi)
@@ -0,0 +1,131 @@
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+import db
+import metrics
+
+# 免费会员每天的使用次数、升级所需点数和付费会员天数
+DAILY_FREE_USES = 5
+PREMIUM_COST = 100
+PREMIUM_DAYS = 30
+# 用户状态缓存的有效时间（秒）
+USER_STATE_TTL = float(os.environ.get('USER_STATE_TTL', 5))
+
+_state_cache = {}
+_state_lock = threading.Lock()
+
+def _today():
+    return datetime.now().strftime('%Y-%m-%d')
+
+# 清除某个用户（或全部用户）的缓存状态，写操作后调用
+def invalidate(username=None):
+    with _state_lock:
+        if username is None:
+            _state_cache.clear()
+        else:
+            _state_cache.pop(username, None)
+
+# 读取用户状态（带短暂缓存，不写数据库）；免费次数按日期惰性计算，跨日时视为已重置
+def get_user_state(username):
+    now = time.monotonic()
+    with _state_lock:
+        cached = _state_cache.get(username)
+        if cached is not None and cached[0] > now:
+            metrics.increment('user_state_cache_hits')
+            return cached[1]
+    metrics.increment('user_state_cache_misses')
+    with metrics.span('db.get_user_state'):
+        row = db.query_one("SELECT membership, role, credits, premium_expiry, free_uses, last_reset FROM users WHERE username = ?", (username,))
+    if row is None:
+        return None
+    membership, role, credits, premium_expiry, free_uses, last_reset = row
+    if not last_reset or str(last_reset) < _today():
+        free_uses = DAILY_FREE_USES
+    state = {
+        'membership': membership,
+        'role': role,
+        'credits': credits if credits is not None else 0,
+        'premium_expiry': premium_expiry,
+        'free_uses': free_uses if free_uses is not None else DAILY_FREE_USES,
+        'last_reset': last_reset,
+    }
+    with _state_lock:
+        _state_cache[username] = (now + USER_STATE_TTL, state)
+    return state
+
+# 扣除一次免费次数：跨日重置与扣减在同一条语句中完成，次数不足时不修改
+# 成功时返回剩余次数，否则返回 None
+@metrics.timed('db.consume_free_use')
+def consume_free_use(username):
+    today = _today()
+    with db.transaction() as conn:
+        updated = conn.execute("""
+            UPDATE users
+            SET free_uses = CASE WHEN last_reset IS NULL OR last_reset < :today THEN :daily - 1
+                                 ELSE free_uses - 1 END,
+                last_reset = :today
+            WHERE username = :username
+              AND (last_reset IS NULL OR last_reset < :today OR free_uses > 0)
+        """, {'today': today, 'daily': DAILY_FREE_USES, 'username': username}).rowcount
+        remaining = conn.execute("SELECT free_uses FROM users WHERE username = ?", (username,)).fetchone()
+    invalidate(username)
+    if not updated:
+        return None
+    return remaining[0]
+
+# 增加点数，返回新的点数
+@metrics.timed('db.add_credits')
+def add_credits(username, amount):
+    with db.transaction() as conn:
+        conn.execute("UPDATE users SET credits = COALESCE(credits, 0) + ? WHERE username = ?", (amount, username))
+        credits = conn.execute("SELECT credits FROM users WHERE username = ?", (username,)).fetchone()
+    invalidate(username)
+    return credits[0] if credits else None
+
+# 使用点数升级为付费会员：点数足够且当前没有有效会员资格时才扣点并升级
+@metrics.timed('db.purchase_premium')
+def purchase_premium(username):
+    today = _today()
+    expiry_date = (datetime.now() + timedelta(days=PREMIUM_DAYS)).strftime('%Y-%m-%d')
+    updated = db.execute("""
+        UPDATE users
+        SET credits = credits - :cost, membership = 'premium', premium_expiry = :expiry
+        WHERE username = :username
+          AND credits >= :cost
+          AND (premium_expiry IS NULL OR premium_expiry <= :today)
+    """, {'cost': PREMIUM_COST, 'expiry': expiry_date, 'username': username, 'today': today})
+    invalidate(username)
+    return updated > 0
+
+# 付费会员到期时降级为免费会员（只在确实到期时修改）
+@metrics.timed('db.expire_premium')
+def expire_premium(username):
+    updated = db.execute("""
+        UPDATE users SET membership = 'free', premium_expiry = NULL
+        WHERE username = ? AND membership = 'premium' AND premium_expiry IS NOT NULL AND premium_expiry <= ?
+    """, (username, _today()))
+    invalidate(username)
+    return updated > 0
+
+# 重置所有免费用户的使用次数
+@metrics.timed('db.reset_all_free_uses')
+def reset_all_free_uses():
+    db.execute("UPDATE users SET free_uses = ?, last_reset = ? WHERE membership = 'free'", (DAILY_FREE_USES, _today()))
+    invalidate()
+
+# 批量重置指定用户的免费次数，在一个事务中完成
+@metrics.timed('db.reset_free_uses_for')
+def reset_free_uses_for(usernames):
+    with db.transaction() as conn:
+        conn.executemany("UPDATE users SET free_uses = ?, last_reset = ? WHERE username = ?",
+                         [(DAILY_FREE_USES, _today(), username) for username in usernames])
+    invalidate()
+
+# 批量为指定用户增加点数，在一个事务中完成
+@metrics.timed('db.add_credits_to')
+def add_credits_to(usernames, amount):
+    with db.transaction() as conn:
+        conn.executemany("UPDATE users SET credits = COALESCE(credits, 0) + ? WHERE username = ?",
+                         [(amount, username) for username in usernames])
+    invalidate()
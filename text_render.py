@@ -0,0 +1,256 @@
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+# 编辑文字所用的字体文件（TrueType/OpenType）；未设置时使用 PyMuPDF 内置的 CJK 字体，与导出的 PDF 一致
+FONT_PATH = os.environ.get('EDIT_FONT_PATH') or None
+BUILTIN_FONT = 'china-s'
+# 同时保留的字号数（每个字号一份字体、字宽表和字形缓存）及每个字号缓存的字形数
+FONT_CACHE_SIZES = int(os.environ.get('TEXT_FONT_CACHE_SIZES', 32))
+GLYPH_CACHE_SIZE = int(os.environ.get('TEXT_GLYPH_CACHE_SIZE', 4096))
+# 行高为字号（像素）的倍数；自动缩小字号时的最小字号（像素）
+LINE_SPACING = 1.25
+MIN_FONT_PX = 6
+
+_CJK_PATTERN = re.compile('[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+# 不能出现在行首的标点（逗号、句号、右括号等）和不能出现在行尾的标点（左括号、左引号等）
+NO_LINE_START = set("，。、；：？！）」』】》〉〕］｝”’…‥・ー々ぁぃぅぇぉっゃゅょァィゥェォッャュョ,.;:?!)]}%")
+NO_LINE_END = set("（「『【《〈〔［｛“‘([{$")
+
+_font_path = None
+_font_path_lock = threading.Lock()
+
+# 内置字体写入临时目录一次，之后按路径打开（各字号共用文件，不在内存中复制字体数据）
+def font_path():
+    global _font_path
+    if FONT_PATH:
+        return FONT_PATH
+    if _font_path is None:
+        with _font_path_lock:
+            if _font_path is None:
+                import fitz  # PyMuPDF
+
+                data = fitz.Font(BUILTIN_FONT).buffer
+                path = os.path.join(tempfile.gettempdir(), f"edit_font_{hashlib.sha1(data).hexdigest()[:12]}.ttf")
+                if not os.path.exists(path):
+                    fd, tmp = tempfile.mkstemp(suffix='.ttf')
+                    with os.fdopen(fd, 'wb') as f:
+                        f.write(data)
+                    os.replace(tmp, path)
+                _font_path = path
+    return _font_path
+
+# 一个字号（及描边宽度）的字体：字宽和栅格化后的字形按需计算并缓存
+class FontFace:
+    def __init__(self, path, size, stroke=0):
+        self.font = ImageFont.truetype(path, size)
+        self.size = size
+        self.stroke = stroke
+        self.ascent, self.descent = self.font.getmetrics()
+        self.line_height = int(round(size * LINE_SPACING))
+        self._advances = {}
+        self._widths = {}
+        self._glyphs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def advance(self, char):
+        width = self._advances.get(char)
+        if width is None:
+            width = self._advances[char] = self.font.getlength(char)
+        return width
+
+    # 文字宽度为各字宽之和（绘制时也按字宽逐字定位，测量与绘制结果一致）
+    # 分行时同一片段会在多个字号下反复测量，片段宽度也按字号缓存（超出上限时整个清空）
+    def text_width(self, text):
+        width = self._widths.get(text)
+        if width is None:
+            if len(self._widths) >= GLYPH_CACHE_SIZE:
+                self._widths.clear()
+            width = self._widths[text] = sum(map(self.advance, text))
+        return width
+
+    # 字形的灰度遮罩及其相对于笔位置（行顶部）的偏移；空白字符返回 None
+    def glyph(self, char):
+        with self._lock:
+            if char in self._glyphs:
+                self._glyphs.move_to_end(char)
+                return self._glyphs[char]
+        left, top, right, bottom = self.font.getbbox(char, stroke_width=self.stroke)
+        glyph = None
+        if right > left and bottom > top:
+            image = Image.new('L', (right - left, bottom - top), 0)
+            ImageDraw.Draw(image).text((-left, -top), char, font=self.font, fill=255, stroke_width=self.stroke)
+            mask = np.asarray(image)
+            if mask.any():
+                glyph = (mask, left, top)
+        with self._lock:
+            self._glyphs[char] = glyph
+            if len(self._glyphs) > GLYPH_CACHE_SIZE:
+                self._glyphs.popitem(last=False)
+        return glyph
+
+    # 多行文字绘制的范围（相对于第一行左上角）：各行字形的实际范围（含描边），
+    # 右边界同时不小于按字宽排列的宽度（绘制时逐字按字宽定位）
+    def extent(self, lines):
+        boxes = []
+        for i, line in enumerate(lines):
+            if not line.strip():
+                continue
+            left, top, right, bottom = self.font.getbbox(line, stroke_width=self.stroke)
+            right = max(right, int(np.ceil(self.text_width(line))) + self.stroke)
+            y = i * self.line_height
+            boxes.append((left, top + y, right, bottom + y))
+        if not boxes:
+            return 0, 0, 0, 0
+        return (min(b[0] for b in boxes), min(b[1] for b in boxes),
+                max(b[2] for b in boxes), max(b[3] for b in boxes))
+
+@lru_cache(maxsize=FONT_CACHE_SIZES)
+def get_face(size, stroke=0):
+    return FontFace(font_path(), size, stroke)
+
+def is_cjk(char):
+    return _CJK_PATTERN.match(char) is not None
+
+# 把一段文字切成不可再分的片段，片段之间可以换行：
+# 中日韩文字每个字都可断开，拉丁文字只在空格后断开（空格留在前一片段末尾），并遵守行首、行尾禁则
+def _segments(text):
+    segment = ""
+    for char in text:
+        if segment:
+            last = segment[-1]
+            breakable = ((last == ' ' and char != ' ') or (char != ' ' and (is_cjk(char) or is_cjk(last))))
+            if breakable and char not in NO_LINE_START and last not in NO_LINE_END:
+                yield segment
+                segment = ""
+        segment += char
+    if segment:
+        yield segment
+
+# 按 max_width（像素）分行：逐个片段放入当前行，放不下时换行；比一行还宽的片段按字断开
+# paragraphs 为各段落的片段列表（与字号无关，只切分一次）；返回 [(行, 宽度)]，行尾空格不计入
+def _wrap(face, paragraphs, max_width):
+    lines = []
+    space = face.advance(' ')
+    for segments in paragraphs:
+        line, width, spaces = "", 0.0, 0
+        for segment in segments:
+            word = segment.rstrip(' ')
+            word_width = face.text_width(word)
+            if line and width + spaces * space + word_width > max_width:
+                lines.append((line, width))
+                line, width = "", 0.0
+            if line:
+                line += ' ' * spaces + word
+                width += spaces * space + word_width
+            elif word_width <= max_width:
+                line, width = word, word_width
+            else:
+                for char in word:
+                    advance = face.advance(char)
+                    if line and width + advance > max_width:
+                        lines.append((line, width))
+                        line, width = "", 0.0
+                    line += char
+                    width += advance
+            spaces = len(segment) - len(word)
+        lines.append((line, width))
+    return lines
+
+def _paragraphs(text):
+    return [list(_segments(paragraph)) for paragraph in text.split('\n')]
+
+# 将文本分行（size 为字号像素）
+def wrap_text(text, max_width, size, stroke=0):
+    if not text:
+        return []
+    return [line for line, _ in _wrap(get_face(size, stroke), _paragraphs(text), max_width)]
+
+# 在 width x height 的区域内排版：以二分查找找出不超过 max_size 且能放下全部文字的最大字号
+# 最小字号仍放不下时使用最小字号（文字超出区域）；返回 (字号, 行列表)
+def fit_text(text, width, height, max_size, stroke=0, min_size=MIN_FONT_PX):
+    max_size = max(int(max_size), 1)
+    min_size = min(min_size, max_size)
+    if not text:
+        return max_size, []
+    paragraphs = _paragraphs(text)
+
+    def layout(size):
+        face = get_face(size, stroke)
+        lines = _wrap(face, paragraphs, width)
+        fits = len(lines) * face.line_height <= height and all(line_width <= width for _, line_width in lines)
+        return [line for line, _ in lines], fits, sum(line_width for _, line_width in lines)
+
+    lines, fits, total = layout(max_size)
+    if fits:
+        return max_size, lines
+    best = (min_size, layout(min_size)[0])
+    # 字宽约与字号成正比：文字总面积（总宽 x 行高）不能超过区域面积，以此缩小搜索上限
+    high = max_size - 1
+    if total > 0:
+        high = min(high, int((width * height * max_size / (LINE_SPACING * total)) ** 0.5) + 1)
+    low = min_size + 1
+    while low <= high:
+        size = (low + high) // 2
+        lines, fits, _ = layout(size)
+        if fits:
+            best = (size, lines)
+            low = size + 1
+        else:
+            high = size - 1
+    return best
+
+# 把一行文字的字形合成为一张遮罩（按字宽逐字定位）；返回 (遮罩, 左上角相对于笔起点的偏移)，全是空白时返回 None
+def _line_mask(face, line):
+    placed = []
+    pen = 0.0
+    for char in line:
+        glyph = face.glyph(char)
+        if glyph is not None:
+            mask, left, top = glyph
+            placed.append((mask, int(round(pen)) + left, top))
+        pen += face.advance(char)
+    if not placed:
+        return None
+    x0 = min(x for _, x, _ in placed)
+    y0 = min(y for _, _, y in placed)
+    x1 = max(x + mask.shape[1] for mask, x, _ in placed)
+    y1 = max(y + mask.shape[0] for mask, _, y in placed)
+    line_mask = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+    for mask, x, y in placed:
+        view = line_mask[y - y0:y - y0 + mask.shape[0], x - x0:x - x0 + mask.shape[1]]
+        np.maximum(view, mask, out=view)
+    return line_mask, x0, y0
+
+def _blend(canvas, mask, x, y, color):
+    height, width = canvas.shape[:2]
+    h, w = mask.shape
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + w, width), min(y + h, height)
+    if x0 >= x1 or y0 >= y1:
+        return
+    alpha = mask[y0 - y:y1 - y, x0 - x:x1 - x].astype(np.uint16)
+    region = canvas[y0:y1, x0:x1]
+    if region.ndim == 3:
+        alpha = alpha[..., None]
+    region[...] = (region * (255 - alpha) + color * alpha + 127) // 255
+
+# 在画布上绘制已分行的文字，(x, y) 为第一行左上角在画布中的位置（可以在画布外，超出部分会被裁掉）
+def draw_lines(canvas, face, lines, x, y, color):
+    if canvas.ndim == 3:
+        # 多出的通道（如 alpha）设为不透明
+        color = np.array((tuple(color) + (255,) * canvas.shape[2])[:canvas.shape[2]], dtype=np.uint16)
+    else:
+        color = int(sum(color) / len(color))
+    for line in lines:
+        placed = _line_mask(face, line)
+        if placed is not None:
+            mask, left, top = placed
+            _blend(canvas, mask, x + left, y + top, color)
+        y += face.line_height